@@ -1,26 +1,32 @@
 """
 API routes for mobile applications
 """
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 from flask_login import login_required, current_user
 from functools import wraps
+import hmac
+import io
 import jwt
+import json
 from datetime import datetime, timedelta
 from models import db, User, SavedSearch, Comparison, Prescription
 from config import Config
-import pandas as pd
-import os
+import numpy as np
+from catalog import SIMILAR_LIMIT, catalog_reloader, encode_cursor, get_catalog, page_offset
+from deltas import read_delta, save_delta
+from interactions import get_interactions, interaction_reloader
+from search_cache import search_cache
 
 api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
 
-# Load medicine data (same as main app)
-DATA_PATH = os.path.join(os.path.dirname(__file__), 'data', 'medicines_sample.csv')
-medicines_df = pd.read_csv(DATA_PATH)
-medicines_df['name'] = medicines_df['name'].fillna('Unknown')
-medicines_df['manufacturer'] = medicines_df['manufacturer'].fillna('Unknown')
-medicines_df['composition'] = medicines_df['composition'].fillna('Unknown')
-medicines_df['uses'] = medicines_df['uses'].fillna('Not specified')
-medicines_df['side_effects'] = medicines_df['side_effects'].fillna('Not specified')
+
+def ndjson_response(record_chunks):
+    """Stream chunks of records as newline-delimited JSON"""
+    def generate():
+        for chunk in record_chunks:
+            yield ''.join(json.dumps(record) + '\n' for record in chunk)
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 
 def token_required(f):
@@ -54,6 +60,22 @@ def token_required(f):
     return decorated
 
 
+def admin_token_required(f):
+    """Decorator to require the configured admin token for admin endpoints"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not Config.ADMIN_TOKEN:
+            return jsonify({'error': 'Admin endpoints are disabled'}), 403
+        
+        token = request.headers.get('X-Admin-Token', '')
+        if not hmac.compare_digest(token.encode(), Config.ADMIN_TOKEN.encode()):
+            return jsonify({'error': 'Invalid admin token'}), 401
+        
+        return f(*args, **kwargs)
+    
+    return decorated
+
+
 @api_bp.route('/auth/login', methods=['POST'])
 def api_login():
     """API endpoint for user login"""
@@ -123,47 +145,274 @@ def api_search_medicines():
     query = request.args.get('q', '').strip().lower()
     manufacturer = request.args.get('manufacturer', '').strip()
     discontinued = request.args.get('discontinued', 'all')
-    limit = int(request.args.get('limit', 50))
+    cursor = request.args.get('cursor', '')
+    fuzzy = request.args.get('fuzzy', '0').lower() in ('1', 'true', 'yes')
     
-    filtered_df = medicines_df.copy()
+    catalog = get_catalog()
     
-    if query:
-        mask = (
-            filtered_df['name'].str.lower().str.contains(query, na=False) |
-            filtered_df['composition'].str.lower().str.contains(query, na=False) |
-            filtered_df['uses'].str.lower().str.contains(query, na=False)
-        )
-        filtered_df = filtered_df[mask]
+    try:
+        limit = max(min(int(request.args.get('limit', 50)), Config.SEARCH_MAX_PAGE_SIZE), 0)
+        page = int(request.args.get('page', 1))
+    except ValueError:
+        return jsonify({'error': 'Invalid limit or page'}), 400
     
-    if manufacturer:
-        filtered_df = filtered_df[
-            filtered_df['manufacturer'].str.lower().str.contains(manufacturer.lower(), na=False)
-        ]
+    try:
+        offset = page_offset(page, cursor, limit)
+        fields = catalog.parse_fields(request.args.get('fields', ''))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    if discontinued == 'active':
-        filtered_df = filtered_df[filtered_df['is_discontinued'] == 'No']
-    elif discontinued == 'discontinued':
-        filtered_df = filtered_df[filtered_df['is_discontinued'] == 'Yes']
+    # Streaming mode returns every match in catalog order, one JSON object per line
+    if request.args.get('format') == 'ndjson':
+        row_ids = catalog.search(query, manufacturer, discontinued)
+        return ndjson_response(catalog.iter_records(row_ids, Config.EXPORT_CHUNK_SIZE, fields))
     
-    # Limit results
-    filtered_df = filtered_df.head(limit)
+    result = catalog.search_page(query, manufacturer, discontinued, limit, offset, fuzzy, facets=True)
     
-    medicines = filtered_df.to_dict('records')
+    # Only the requested page of rows, and only the requested fields, are converted to dictionaries
+    medicines = catalog.records(result.row_ids, fields)
     
-    return jsonify({
+    next_offset = offset + len(result.row_ids)
+    response = {
         'count': len(medicines),
+        'total': result.total,
+        'page': offset // limit + 1 if limit else 1,
+        'next_cursor': encode_cursor(next_offset) if next_offset < result.total else None,
+        'facets': result.facets,
         'medicines': medicines
+    }
+    if result.corrected_query:
+        response['corrected_query'] = result.corrected_query
+    
+    return jsonify(response), 200
+
+
+@api_bp.route('/medicines/search/batch', methods=['POST'])
+def api_search_medicines_batch():
+    """API endpoint to run many medicine searches in one request"""
+    data = request.get_json(silent=True)
+    
+    if not data or not isinstance(data.get('queries'), list) or not data['queries']:
+        return jsonify({'error': 'A non-empty list of queries is required'}), 400
+    
+    if len(data['queries']) > Config.SEARCH_BATCH_MAX_QUERIES:
+        return jsonify({
+            'error': f'At most {Config.SEARCH_BATCH_MAX_QUERIES} queries are allowed per batch'
+        }), 400
+    
+    searches = []
+    for item in data['queries']:
+        if not isinstance(item, dict):
+            return jsonify({'error': 'Each query must be an object'}), 400
+        
+        try:
+            limit = max(min(int(item.get('limit', 50)), Config.SEARCH_MAX_PAGE_SIZE), 0)
+            page = int(item.get('page', 1))
+            offset = page_offset(page, '', limit)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid limit or page'}), 400
+        
+        # null counts as not given
+        query = item.get('q') or ''
+        manufacturer = item.get('manufacturer') or ''
+        discontinued = item.get('discontinued') or 'all'
+        if not isinstance(query, str) or not isinstance(manufacturer, str):
+            return jsonify({'error': 'q and manufacturer must be strings'}), 400
+        if discontinued not in ('all', 'active', 'discontinued'):
+            return jsonify({'error': "discontinued must be 'all', 'active' or 'discontinued'"}), 400
+        # Read like the GET endpoint's fuzzy parameter, so "0" and "false" stay off
+        fuzzy = str(item.get('fuzzy', False)).lower() in ('1', 'true', 'yes')
+        
+        searches.append({
+            'query': query,
+            'manufacturer': manufacturer,
+            'discontinued': discontinued,
+            'limit': limit,
+            'offset': offset,
+            'fuzzy': fuzzy
+        })
+    
+    catalog = get_catalog()
+    pages = catalog.search_batch(searches)
+    
+    # Convert every returned row to a dictionary once, even if several queries share it
+    records = catalog.records_by_id([row_id for page in pages for row_id in page.row_ids])
+    
+    results = []
+    for search, page in zip(searches, pages):
+        result = {
+            'q': search['query'],
+            'count': len(page.row_ids),
+            'total': page.total,
+            'medicines': [records[int(row_id)] for row_id in page.row_ids]
+        }
+        if page.corrected_query:
+            result['corrected_query'] = page.corrected_query
+        results.append(result)
+    
+    return jsonify({
+        'count': len(results),
+        'results': results
+    }), 200
+
+
+@api_bp.route('/medicines/export', methods=['GET'])
+def api_export_medicines():
+    """API endpoint to stream the full medicine catalog as NDJSON"""
+    catalog = get_catalog()
+    
+    try:
+        fields = catalog.parse_fields(request.args.get('fields', ''))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    row_ids = np.arange(len(catalog), dtype=np.int32)
+    return ndjson_response(catalog.iter_records(row_ids, Config.EXPORT_CHUNK_SIZE, fields))
+
+
+@api_bp.route('/medicines/suggest', methods=['GET'])
+def api_suggest_medicines():
+    """API endpoint for search-as-you-type suggestions"""
+    prefix = request.args.get('prefix', '').strip()
+    
+    try:
+        limit = max(min(int(request.args.get('limit', 10)), 50), 1)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    
+    if not prefix:
+        return jsonify({'error': 'Prefix is required'}), 400
+    
+    return jsonify({
+        'prefix': prefix,
+        'suggestions': get_catalog().suggest(prefix, limit)
+    }), 200
+
+
+@api_bp.route('/medicines', methods=['GET'])
+def api_get_medicines():
+    """API endpoint to get many medicines by stable id or index in one call"""
+    ids_str = request.args.get('ids', '')
+    catalog = get_catalog()
+    
+    ids = [medicine_id.strip() for medicine_id in ids_str.split(',') if medicine_id.strip()]
+    
+    try:
+        fields = catalog.parse_fields(request.args.get('fields', ''))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if not ids:
+        return jsonify({'error': 'Medicine ids are required'}), 400
+    
+    if len(ids) > Config.MULTI_GET_MAX_IDS:
+        return jsonify({'error': f'At most {Config.MULTI_GET_MAX_IDS} ids are allowed per request'}), 400
+    
+    medicines, missing = catalog.get_many(ids, fields)
+    
+    return jsonify({
+        'count': len(medicines),
+        'medicines': medicines,
+        'missing': missing
+    }), 200
+
+
+@api_bp.route('/medicines/<medicine_id>', methods=['GET'])
+def api_get_medicine(medicine_id):
+    """API endpoint to get medicine details by stable id or index"""
+    catalog = get_catalog()
+    
+    try:
+        fields = catalog.parse_fields(request.args.get('fields', ''))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    index = catalog.resolve(medicine_id)
+    if index is None:
+        return jsonify({'error': 'Medicine not found'}), 404
+    
+    # Answered from the catalog version and id alone, without reading the row
+    etag = catalog.etag(index, fields)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    
+    if fields is None:
+        # Full records are encoded once per catalog and served as stored
+        response = Response(b'{"medicine":' + catalog.medicine_json(index) + b'}\n',
+                            mimetype='application/json')
+    else:
+        response = jsonify({'medicine': catalog.get(index, fields)})
+    response.set_etag(etag)
+    return response, 200
+
+
+@api_bp.route('/medicines/<medicine_id>/similar', methods=['GET'])
+def api_get_similar(medicine_id):
+    """API endpoint to list the medicines with the most similar uses, composition and side effects"""
+    catalog = get_catalog()
+    
+    try:
+        limit = max(int(request.args.get('limit', SIMILAR_LIMIT)), 0)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    
+    try:
+        fields = catalog.parse_fields(request.args.get('fields', ''))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    index = catalog.resolve(medicine_id)
+    if index is None:
+        return jsonify({'error': 'Medicine not found'}), 404
+    
+    # A lookup in the neighbour table built with the catalog
+    row_ids, scores = catalog.similar(index, limit)
+    similar = catalog.records(row_ids, fields)
+    for record, score in zip(similar, scores):
+        record['score'] = round(float(score), 3)
+    
+    return jsonify({
+        'medicine': catalog.records([index], fields)[0],
+        'count': len(similar),
+        'similar': similar
     }), 200
 
 
-@api_bp.route('/medicines/<int:index>', methods=['GET'])
-def api_get_medicine(index):
-    """API endpoint to get medicine details"""
-    if index < 0 or index >= len(medicines_df):
+@api_bp.route('/medicines/<medicine_id>/substitutes', methods=['GET'])
+def api_get_substitutes(medicine_id):
+    """API endpoint to list generic equivalents: the same ingredients in the same strengths"""
+    catalog = get_catalog()
+    discontinued = request.args.get('discontinued', 'all')
+    
+    try:
+        limit = max(min(int(request.args.get('limit', 50)), Config.SEARCH_MAX_PAGE_SIZE), 0)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    
+    try:
+        fields = catalog.parse_fields(request.args.get('fields', ''))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    index = catalog.resolve(medicine_id)
+    if index is None:
         return jsonify({'error': 'Medicine not found'}), 404
     
-    medicine = medicines_df.iloc[index].to_dict()
-    return jsonify({'medicine': medicine}), 200
+    substitutes = catalog.substitutes(index, discontinued)
+    
+    return jsonify({
+        'medicine': catalog.records([index], fields)[0],
+        'signature': catalog.substitute_groups.signature(index),
+        'components': [
+            {'ingredient': name, 'strength': amount, 'unit': unit}
+            for name, amount, unit in catalog.components(index)
+        ],
+        'total': len(substitutes),
+        'count': min(len(substitutes), limit),
+        'substitutes': catalog.records(substitutes[:limit], fields)
+    }), 200
 
 
 @api_bp.route('/saved-searches', methods=['GET', 'POST'])
@@ -255,17 +504,33 @@ def api_check_interactions():
     if not isinstance(indices, list) or len(indices) < 2:
         return jsonify({'error': 'At least 2 medicine indices are required'}), 400
     
+    catalog = get_catalog()
+    
+    try:
+        fields = catalog.parse_fields(request.args.get('fields', ''))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # The checker needs the name even when the response omits it
+    lookup_fields = None if fields is None else list(dict.fromkeys(fields + ['name']))
+    
+    # Stable ids, or positional indices for older clients
+    if not all(isinstance(idx, (int, str)) and not isinstance(idx, bool) for idx in indices):
+        return jsonify({'error': 'Invalid medicine indices'}), 400
+    
     # Get medicines
-    medicines = []
-    for idx in indices:
-        if 0 <= idx < len(medicines_df):
-            medicines.append(medicines_df.iloc[idx].to_dict())
+    medicines, _ = catalog.get_many(indices, lookup_fields)
     
     if len(medicines) < 2:
         return jsonify({'error': 'Invalid medicine indices'}), 400
     
-    # Check for interactions (basic implementation)
-    interactions = check_drug_interactions(medicines)
+    # Check for interactions
+    interactions = check_drug_interactions(catalog, medicines)
+    
+    if fields is not None:
+        medicines = [
+            {field: medicine[field] for field in ('id', 'index', *fields)} for medicine in medicines
+        ]
     
     return jsonify({
         'medicines': medicines,
@@ -273,88 +538,24 @@ def api_check_interactions():
     }), 200
 
 
-def check_drug_interactions(medicines):
+def check_drug_interactions(catalog, medicines):
     """
-    Check for potential drug interactions
-    This is a simplified implementation - in production, use a proper drug interaction database
+    Check for potential drug interactions between catalog records, using
+    the live interaction database
     """
-    interactions = []
-    
-    # Extract active ingredients from all medicines
-    compositions = []
-    for med in medicines:
-        comp = str(med.get('composition', '')).lower()
-        compositions.append({
-            'medicine': med['name'],
-            'composition': comp,
-            'ingredients': [word.strip() for word in comp.split() if len(word.strip()) > 3]
-        })
-    
-    # Check for common interaction patterns (simplified)
-    interaction_rules = {
-        'paracetamol': {
-            'warning': 'Do not take multiple medicines containing Paracetamol together',
-            'severity': 'high'
-        },
-        'aspirin': {
-            'warning': 'Aspirin may interact with blood thinners and NSAIDs',
-            'severity': 'medium'
-        },
-        'ibuprofen': {
-            'warning': 'Avoid taking with other NSAIDs or aspirin',
-            'severity': 'medium'
-        }
-    }
-    
-    # Check if multiple medicines contain the same active ingredient
-    for i, comp1 in enumerate(compositions):
-        for j, comp2 in enumerate(compositions[i+1:], i+1):
-            # Check for common ingredients
-            common = set(comp1['ingredients']) & set(comp2['ingredients'])
-            
-            if common:
-                interactions.append({
-                    'medicine1': comp1['medicine'],
-                    'medicine2': comp2['medicine'],
-                    'type': 'duplicate_ingredient',
-                    'ingredients': list(common),
-                    'warning': 'These medicines contain common active ingredients',
-                    'severity': 'high',
-                    'recommendation': 'Consult a healthcare professional before taking together'
-                })
-            
-            # Check for known interactions
-            for ingredient in comp1['ingredients']:
-                if ingredient in interaction_rules:
-                    for ingredient2 in comp2['ingredients']:
-                        if ingredient != ingredient2:
-                            interactions.append({
-                                'medicine1': comp1['medicine'],
-                                'medicine2': comp2['medicine'],
-                                'type': 'known_interaction',
-                                'warning': interaction_rules[ingredient]['warning'],
-                                'severity': interaction_rules[ingredient]['severity'],
-                                'recommendation': 'Consult a healthcare professional'
-                            })
-    
-    if not interactions:
-        return [{
-            'type': 'no_interactions',
-            'message': 'No known interactions detected',
-            'severity': 'none',
-            'recommendation': 'Always consult a healthcare professional before taking multiple medications'
-        }]
-    
-    return interactions
+    return get_interactions().check([
+        (medicine['name'], catalog.ingredients(medicine['index'])) for medicine in medicines
+    ])
 
 
 @api_bp.route('/stats', methods=['GET'])
 def api_stats():
     """API endpoint to get database statistics"""
-    total_medicines = len(medicines_df)
-    total_manufacturers = medicines_df['manufacturer'].nunique()
-    discontinued_count = len(medicines_df[medicines_df['is_discontinued'] == 'Yes'])
-    active_count = len(medicines_df[medicines_df['is_discontinued'] == 'No'])
+    catalog = get_catalog()
+    total_medicines = len(catalog)
+    total_manufacturers = len(catalog.manufacturer_facet.labels)
+    discontinued_count = len(catalog.status_facet.bitmap('Yes'))
+    active_count = len(catalog.status_facet.bitmap('No'))
     
     return jsonify({
         'total_medicines': total_medicines,
@@ -362,3 +563,79 @@ def api_stats():
         'discontinued_count': discontinued_count,
         'active_count': active_count
     }), 200
+
+
+@api_bp.route('/stats/search-cache', methods=['GET'])
+def api_search_cache_stats():
+    """API endpoint to get search result cache counters"""
+    return jsonify(search_cache.stats()), 200
+
+
+@api_bp.route('/admin/catalog', methods=['GET'])
+@admin_token_required
+def api_catalog_status():
+    """API endpoint to get the live catalog version and reload state"""
+    return jsonify(catalog_reloader.status()), 200
+
+
+@api_bp.route('/admin/catalog/reload', methods=['POST'])
+@admin_token_required
+def api_reload_catalog():
+    """API endpoint to reload the catalog in the background"""
+    if not catalog_reloader.start_reload():
+        return jsonify({'error': 'A catalog reload is already in progress'}), 409
+    
+    return jsonify({
+        'message': 'Catalog reload started',
+        'status': catalog_reloader.status()
+    }), 202
+
+
+@api_bp.route('/admin/catalog/deltas', methods=['POST'])
+@admin_token_required
+def api_apply_catalog_delta():
+    """API endpoint to store a delta CSV and apply it to the live catalog"""
+    if not Config.CATALOG_DELTA_DIR:
+        return jsonify({'error': 'Catalog deltas are disabled'}), 400
+    
+    body = request.get_data()
+    if not body:
+        return jsonify({'error': 'A delta CSV request body is required'}), 400
+    
+    try:
+        read_delta(io.BytesIO(body), get_catalog().source_columns)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    save_delta(Config.CATALOG_DELTA_DIR, body)
+    try:
+        summaries = catalog_reloader.apply_deltas()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 500
+    
+    return jsonify({
+        'version': get_catalog().version,
+        'deltas': summaries
+    }), 200
+
+
+@api_bp.route('/admin/interactions', methods=['GET'])
+@admin_token_required
+def api_interactions_status():
+    """API endpoint to get the size and load state of the interaction database"""
+    return jsonify(interaction_reloader.status()), 200
+
+
+@api_bp.route('/admin/interactions/reload', methods=['POST'])
+@admin_token_required
+def api_reload_interactions():
+    """API endpoint to reload the interaction database from its file"""
+    try:
+        interaction_reloader.reload()
+    except (OSError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'message': 'Interaction database reloaded',
+        'status': interaction_reloader.status()
+    }), 200
@@ -6,7 +6,6 @@ A web application to search and view medicine information using the 1mg medicine
 from flask import Flask, render_template, request, jsonify, flash, redirect, url_for
 from flask_login import LoginManager, login_required, current_user
 from flask_babel import Babel, gettext
-import pandas as pd
 import os
 import json
 from werkzeug.utils import secure_filename
@@ -17,6 +16,8 @@ import re
 # Import configuration and models
 from config import Config
 from models import db, User, SavedSearch, Comparison, Prescription
+from catalog import catalog_reloader, get_catalog, page_offset
+from interactions import get_interactions, interaction_reloader
 
 app = Flask(__name__)
 app.config.from_object(Config)
@@ -52,16 +53,12 @@ from api import api_bp
 app.register_blueprint(auth_bp)
 app.register_blueprint(api_bp)
 
-# Load the medicine dataset
-DATA_PATH = os.path.join(os.path.dirname(__file__), 'data', 'medicines_sample.csv')
-medicines_df = pd.read_csv(DATA_PATH)
-
-# Clean and prepare data
-medicines_df['name'] = medicines_df['name'].fillna('Unknown')
-medicines_df['manufacturer'] = medicines_df['manufacturer'].fillna('Unknown')
-medicines_df['composition'] = medicines_df['composition'].fillna('Unknown')
-medicines_df['uses'] = medicines_df['uses'].fillna('Not specified')
-medicines_df['side_effects'] = medicines_df['side_effects'].fillna('Not specified')
+# Load the shared medicine catalog and interaction database once at startup
+get_catalog()
+get_interactions()
+if Config.CATALOG_WATCH_INTERVAL:
+    catalog_reloader.watch(Config.CATALOG_WATCH_INTERVAL)
+    interaction_reloader.watch(Config.CATALOG_WATCH_INTERVAL)
 
 # Create upload folder if it doesn't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -79,90 +76,72 @@ def search():
     query = request.args.get('q', '').strip().lower()
     manufacturer_filter = request.args.get('manufacturer', '').strip()
     discontinued_filter = request.args.get('discontinued', 'all')
+    page_size = app.config['SEARCH_PAGE_SIZE']
     
     if not query and not manufacturer_filter:
         return render_template('search.html', medicines=[], query='')
     
-    # Filter medicines
-    filtered_df = medicines_df.copy()
-    
-    if query:
-        # Search in name, composition, and uses
-        mask = (
-            filtered_df['name'].str.lower().str.contains(query, na=False) |
-            filtered_df['composition'].str.lower().str.contains(query, na=False) |
-            filtered_df['uses'].str.lower().str.contains(query, na=False)
-        )
-        filtered_df = filtered_df[mask]
-    
-    if manufacturer_filter:
-        filtered_df = filtered_df[
-            filtered_df['manufacturer'].str.lower().str.contains(manufacturer_filter.lower(), na=False)
-        ]
+    try:
+        offset = page_offset(request.args.get('page', 1, type=int), request.args.get('cursor', ''), page_size)
+    except ValueError:
+        offset = 0
     
-    if discontinued_filter == 'active':
-        filtered_df = filtered_df[filtered_df['is_discontinued'] == 'No']
-    elif discontinued_filter == 'discontinued':
-        filtered_df = filtered_df[filtered_df['is_discontinued'] == 'Yes']
+    # Filter and rank through the shared catalog indexes and result cache
+    catalog = get_catalog()
+    result = catalog.search_page(query, manufacturer_filter, discontinued_filter, page_size, offset)
     
-    # Convert to list of dictionaries
-    medicines = filtered_df.to_dict('records')
+    # Convert only the current page to dictionaries
+    medicines = catalog.records(result.row_ids)
     
-    return render_template('search.html', medicines=medicines, query=query)
+    return render_template('search.html', medicines=medicines, query=query,
+                         total=result.total, page=offset // page_size + 1,
+                         has_next=offset + page_size < result.total)
 
 
-@app.route('/medicine/<int:index>')
-def medicine_detail(index):
-    """View detailed information about a specific medicine"""
-    if index < 0 or index >= len(medicines_df):
+@app.route('/medicine/<medicine_id>')
+def medicine_detail(medicine_id):
+    """View detailed information about a specific medicine, by stable id or index"""
+    catalog = get_catalog()
+    index = catalog.resolve(medicine_id)
+    if index is None:
         return render_template('error.html', message='Medicine not found'), 404
+    medicine = catalog.get(index)
     
-    medicine = medicines_df.iloc[index].to_dict()
+    # Find alternatives based on shared ingredients
+    alternatives = find_alternatives(catalog, index)
     
-    # Find alternatives based on similar composition
-    alternatives = find_alternatives(medicine, index)
+    # Similar medicines come precomputed with the catalog
+    similar_ids, _ = catalog.similar(index)
+    similar = catalog.records(similar_ids, ['name', 'manufacturer', 'composition', 'uses'])
     
-    return render_template('medicine.html', medicine=medicine, alternatives=alternatives, index=index)
+    return render_template('medicine.html', medicine=medicine, alternatives=alternatives,
+                           similar=similar, index=index)
 
 
-def find_alternatives(medicine, current_index):
-    """Find alternative medicines with similar composition"""
-    alternatives = []
-    
-    # Extract main active ingredient from composition
-    composition = str(medicine.get('composition', '')).lower()
-    
-    # Search for medicines with similar composition
-    for idx, row in medicines_df.iterrows():
-        if idx != current_index:
-            if any(word in str(row['composition']).lower() for word in composition.split() if len(word) > 3):
-                alternatives.append({
-                    'index': idx,
-                    'name': row['name'],
-                    'manufacturer': row['manufacturer'],
-                    'composition': row['composition'],
-                    'pack_size_label': row['pack_size_label']
-                })
-                if len(alternatives) >= 5:  # Limit to 5 alternatives
-                    break
-    
-    return alternatives
+def find_alternatives(catalog, current_index):
+    """Find alternative medicines, ranked by how many ingredients they share"""
+    return catalog.records(
+        catalog.alternatives(current_index),
+        ['name', 'manufacturer', 'composition', 'pack_size_label']
+    )
 
 
 @app.route('/manufacturers')
 def get_manufacturers():
     """Get list of all manufacturers"""
-    manufacturers = sorted(medicines_df['manufacturer'].unique().tolist())
+    manufacturers = get_catalog().manufacturer_facet.labels
     return jsonify(manufacturers)
 
 
 @app.route('/stats')
 def stats():
     """Display statistics about the medicine database"""
-    total_medicines = len(medicines_df)
-    total_manufacturers = medicines_df['manufacturer'].nunique()
-    discontinued_count = len(medicines_df[medicines_df['is_discontinued'] == 'Yes'])
-    active_count = len(medicines_df[medicines_df['is_discontinued'] == 'No'])
+    catalog = get_catalog()
+    medicines_df = catalog.df
+    total_medicines = len(catalog)
+    total_manufacturers = len(catalog.manufacturer_facet.labels)
+    discontinued_count = len(catalog.status_facet.bitmap('Yes'))
+    active_count = len(catalog.status_facet.bitmap('No'))
     
     # Top manufacturers
     top_manufacturers = medicines_df['manufacturer'].value_counts().head(10).to_dict()
@@ -231,18 +210,12 @@ def compare():
     if not indices_str:
         return render_template('compare.html', medicines=[])
     
-    try:
-        indices = [int(i) for i in indices_str.split(',') if i.strip()]
-        medicines = []
-        
-        for idx in indices:
-            if 0 <= idx < len(medicines_df):
-                medicines.append(medicines_df.iloc[idx].to_dict())
-        
-        return render_template('compare.html', medicines=medicines, indices=indices)
-    except ValueError:
-        flash('Invalid medicine indices', 'error')
-        return redirect(url_for('search'))
+    # Stable ids or, for old links and saved comparisons, positional indices
+    keys = [key.strip() for key in indices_str.split(',') if key.strip()]
+    medicines, _ = get_catalog().get_many(keys)
+    indices = [medicine['id'] for medicine in medicines]
+    
+    return render_template('compare.html', medicines=medicines, indices=indices)
 
 
 @app.route('/save-comparison', methods=['POST'])
@@ -281,25 +254,17 @@ def interactions():
     if not indices_str:
         return render_template('interactions.html', medicines=[], interactions=[])
     
-    try:
-        indices = [int(i) for i in indices_str.split(',') if i.strip()]
-        medicines = []
-        
-        for idx in indices:
-            if 0 <= idx < len(medicines_df):
-                medicines.append({
-                    'index': idx,
-                    'data': medicines_df.iloc[idx].to_dict()
-                })
-        
-        # Check for interactions
-        from api import check_drug_interactions
-        interactions = check_drug_interactions([m['data'] for m in medicines])
-        
-        return render_template('interactions.html', medicines=medicines, interactions=interactions, indices=indices)
-    except ValueError:
-        flash('Invalid medicine indices', 'error')
-        return redirect(url_for('search'))
+    keys = [key.strip() for key in indices_str.split(',') if key.strip()]
+    catalog = get_catalog()
+    records, _ = catalog.get_many(keys)
+    medicines = [{'id': record['id'], 'index': record['index'], 'data': record} for record in records]
+    indices = [medicine['id'] for medicine in medicines]
+    
+    # Check for interactions
+    from api import check_drug_interactions
+    interactions = check_drug_interactions(catalog, [m['data'] for m in medicines])
+    
+    return render_template('interactions.html', medicines=medicines, interactions=interactions, indices=indices)
 
 
 @app.route('/prescription-upload', methods=['GET', 'POST'])
@@ -413,15 +378,14 @@ def price_comparison():
 @app.route('/api/prices/compare')
 def compare_prices():
     """API endpoint to compare medicine prices"""
-    medicine_index = request.args.get('medicine', type=int)
-    
-    if medicine_index is None:
-        return jsonify({'error': 'Medicine index required'}), 400
+    medicine_id = request.args.get('medicine', '').strip()
     
-    if not (0 <= medicine_index < len(medicines_df)):
-        return jsonify({'error': 'Invalid medicine index'}), 404
+    if not medicine_id:
+        return jsonify({'error': 'Medicine id required'}), 400
     
-    medicine = medicines_df.iloc[medicine_index].to_dict()
+    medicine = get_catalog().get(medicine_id)
+    if medicine is None:
+        return jsonify({'error': 'Invalid medicine id'}), 404
     
     # Sample price data - in production, integrate with actual pharmacy APIs
     import random
@@ -470,26 +434,27 @@ def compare_prices():
 @login_required
 def analytics_dashboard():
     """Advanced analytics dashboard"""
+    catalog = get_catalog()
+    medicines_df = catalog.df
     # Get user statistics
     user_saved_searches = SavedSearch.query.filter_by(user_id=current_user.id).count()
     user_comparisons = Comparison.query.filter_by(user_id=current_user.id).count()
     user_prescriptions = Prescription.query.filter_by(user_id=current_user.id).count()
     
     # Database statistics
-    total_medicines = len(medicines_df)
-    active_medicines = len(medicines_df[medicines_df['is_discontinued'] == 'No'])
-    discontinued_medicines = len(medicines_df[medicines_df['is_discontinued'] == 'Yes'])
+    total_medicines = len(catalog)
+    active_medicines = len(catalog.status_facet.bitmap('No'))
+    discontinued_medicines = len(catalog.status_facet.bitmap('Yes'))
     
     # Top manufacturers
     manufacturer_counts = medicines_df['manufacturer'].value_counts().head(10)
     
-    # Medicine categories (based on uses)
-    categories = {}
-    for uses in medicines_df['uses'].dropna():
-        words = uses.lower().split()
-        for word in ['pain', 'fever', 'infection', 'diabetes', 'pressure', 'cardiac', 'respiratory']:
-            if word in uses.lower():
-                categories[word] = categories.get(word, 0) + 1
+    # Medicine categories (based on uses), from the precomputed category bitmaps
+    categories = {
+        category: count
+        for category, count in catalog.category_facet.counts().items()
+        if count
+    }
     
     return render_template('analytics.html',
                          user_stats={
@@ -501,7 +466,7 @@ def analytics_dashboard():
                              'total': total_medicines,
                              'active': active_medicines,
                              'discontinued': discontinued_medicines,
-                             'manufacturers': len(medicines_df['manufacturer'].unique())
+                             'manufacturers': len(catalog.manufacturer_facet.labels)
                          },
                          top_manufacturers=manufacturer_counts.to_dict(),
                          categories=categories)
@@ -538,6 +503,7 @@ def extract_medicines_from_prescription(filepath):
             # For now, return a message about PDF support
             return [{
                 'name': 'PDF OCR not fully implemented',
+                'id': None,
                 'index': -1,
                 'confidence': 'low',
                 'note': 'Install pdf2image for full PDF support'
@@ -549,6 +515,7 @@ def extract_medicines_from_prescription(filepath):
         if not extracted_text:
             return [{
                 'name': 'No text extracted',
+                'id': None,
                 'index': -1,
                 'confidence': 'low'
             }]
@@ -559,6 +526,8 @@ def extract_medicines_from_prescription(filepath):
         
         # Search for medicines in our database that appear in the extracted text
         text_lower = extracted_text.lower()
+        catalog = get_catalog()
+        medicines_df = catalog.df
         
         for idx, row in medicines_df.iterrows():
             medicine_name = row['name'].lower()
@@ -570,6 +539,7 @@ def extract_medicines_from_prescription(filepath):
                 confidence = 'high'
                 found_medicines.append({
                     'name': row['name'],
+                    'id': catalog.ids[idx],
                     'index': int(idx),
                     'confidence': confidence,
                     'composition': row['composition']
@@ -581,6 +551,7 @@ def extract_medicines_from_prescription(filepath):
                     confidence = 'medium'
                     found_medicines.append({
                         'name': row['name'],
+                        'id': catalog.ids[idx],
                         'index': int(idx),
                         'confidence': confidence,
                         'composition': row['composition']
@@ -598,6 +569,7 @@ def extract_medicines_from_prescription(filepath):
                 dosage = match[1]
                 found_medicines.append({
                     'name': f"{medicine_candidate} {dosage}",
+                    'id': None,
                     'index': -1,
                     'confidence': 'low',
                     'note': 'Extracted but not found in database'
@@ -617,6 +589,7 @@ def extract_medicines_from_prescription(filepath):
         else:
             return [{
                 'name': 'No medicines identified',
+                'id': None,
                 'index': -1,
                 'confidence': 'low',
                 'extracted_text': extracted_text[:200]  # First 200 chars
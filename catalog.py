@@ -0,0 +1,1190 @@
+"""
+Shared medicine catalog: loading, cleaning and derived search indexes
+"""
+import argparse
+import base64
+import copy
+import hashlib
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, namedtuple
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from composition import (
+    IngredientIndex, SignatureGroups, ingredient_names, parse_composition, signature
+)
+from config import Config
+import snapshot
+from deltas import DELTA_KEY, list_deltas, read_delta
+from facets import Bitmap, FacetIndex, KeywordFacet
+from search_cache import search_cache
+from similarity import SimilarityIndex
+from search_index import (
+    SEARCH_COLUMNS, BM25Index, PrefixIndex, SpellingIndex, TrigramIndex,
+    pack_strings, tokenize, unpack_strings
+)
+
+logger = logging.getLogger(__name__)
+
+# Fields offered as autocomplete suggestions, keyed by response name
+SUGGEST_FIELDS = {
+    'names': 'name',
+    'compositions': 'composition',
+    'manufacturers': 'manufacturer',
+}
+
+# BM25 field weights: name matches count most, then composition, then uses
+RANKING_WEIGHTS = {
+    'name': 3.0,
+    'composition': 2.0,
+    'uses': 1.0,
+}
+
+# Columns whose words make up the spelling-correction vocabulary
+SPELLING_COLUMNS = ('name', 'composition')
+
+# Placeholder values for missing text fields
+FILL_VALUES = {
+    'name': 'Unknown',
+    'manufacturer': 'Unknown',
+    'composition': 'Unknown',
+    'uses': 'Not specified',
+    'side_effects': 'Not specified',
+}
+
+# Low-cardinality columns held as categorical codes rather than a string per row
+CATEGORY_COLUMNS = ('manufacturer',)
+
+# Yes/No columns held as booleans, with their (false, true) labels; records
+# still show the labels
+FLAG_COLUMNS = {
+    'is_discontinued': ('No', 'Yes'),
+}
+
+# Columns the application reads; lean catalogs drop all others
+LEAN_COLUMNS = (
+    'name', 'manufacturer', 'composition', 'uses', 'side_effects',
+    'pack_size_label', 'short_composition1', 'short_composition2', 'is_discontinued',
+)
+
+# Per-ingredient compositions, used when the composition itself is missing
+SHORT_COMPOSITION_COLUMNS = ('short_composition1', 'short_composition2')
+
+# Alternatives shown for a medicine
+ALTERNATIVES_LIMIT = 5
+
+# Text compared to find similar medicines, the number of similar medicines
+# kept per medicine, and the share of medicines (but at least the row count)
+# above which a term is too common to count
+SIMILARITY_COLUMNS = ('uses', 'composition', 'side_effects')
+SIMILAR_LIMIT = 10
+SIMILARITY_MAX_SHARE = 0.05
+SIMILARITY_MIN_ROWS = 100
+
+# Values of columns left out when a delta adds a medicine
+NEW_MEDICINE_DEFAULTS = dict(FILL_VALUES, is_discontinued='No')
+
+# is_discontinued value selected by each discontinued filter
+DISCONTINUED_STATES = {
+    'active': 'No',
+    'discontinued': 'Yes',
+}
+
+# Therapeutic categories, matched as keywords in the uses column
+THERAPEUTIC_CATEGORIES = (
+    'pain', 'fever', 'infection', 'diabetes', 'pressure', 'cardiac', 'respiratory'
+)
+
+# Keys added to every record besides the catalog columns
+RECORD_KEYS = ('id', 'index')
+
+# One ranked page of search results; facets is None unless requested
+SearchPage = namedtuple('SearchPage', ['row_ids', 'total', 'corrected_query', 'facets'])
+
+
+def is_spelling_term(term):
+    """Return whether a term belongs in the spelling-correction vocabulary"""
+    return term.isalpha() and len(term) > 2
+
+
+def medicine_id(key, occurrence=0):
+    """
+    Return the stable id of a medicine from its (name, manufacturer) key.
+    occurrence numbers repeated keys so duplicate rows get distinct ids.
+    """
+    identity = '\x1f'.join(str(value) for value in key)
+    if occurrence:
+        identity += f'\x1f{occurrence}'
+    return hashlib.sha1(identity.encode()).hexdigest()[:16]
+
+
+def shared_strings(strings):
+    """
+    Return strings as a list in which equal strings are the same object, so
+    a value repeated across rows takes memory once.
+    """
+    shared = {}
+    return [shared.setdefault(string, string) for string in strings]
+
+
+def similarity_documents(df):
+    """
+    Return the lowercased similarity columns of every row of a frame,
+    leaving out missing-value placeholders
+    """
+    columns = [df[column].astype(str).str.lower().tolist() for column in SIMILARITY_COLUMNS]
+    placeholders = [FILL_VALUES[column].lower() for column in SIMILARITY_COLUMNS]
+    return [
+        tuple(value for value, placeholder in zip(values, placeholders) if value != placeholder)
+        for values in zip(*columns)
+    ]
+
+
+def clean_frame(raw):
+    """Parse the medicine CSV bytes and fill in missing text fields"""
+    return pd.read_csv(io.BytesIO(raw)).fillna(FILL_VALUES)
+
+
+def compact_column(column, series):
+    """Convert a category or flag column to its compact dtype"""
+    if column in CATEGORY_COLUMNS:
+        return series.astype('category')
+    if column in FLAG_COLUMNS and series.dtype != bool:
+        return series.eq(FLAG_COLUMNS[column][1])
+    return series
+
+
+def compact_frame(df, lean=False, share_strings=True):
+    """
+    Return df with memory-efficient dtypes: categorical codes, boolean flags
+    and equal text values shared between rows. lean also drops the columns
+    the application never reads; share_strings=False skips sharing text that
+    is known to be shared already.
+    """
+    if lean:
+        df = df[[column for column in df.columns if column in LEAN_COLUMNS]]
+
+    data = {}
+    for column in df.columns:
+        series = compact_column(column, df[column])
+        if series.dtype == object and share_strings:
+            series = pd.Series(shared_strings(series.tolist()), dtype=object)
+        data[column] = series
+    return pd.DataFrame(data)
+
+
+def flag_labels(column, values):
+    """Return the Yes/No labels of a flag column's boolean values"""
+    return np.array(FLAG_COLUMNS[column], dtype=object)[np.asarray(values, dtype=np.intp)]
+
+
+def column_bytes(values):
+    """
+    Return the memory held by a column or list. Text counts each distinct
+    string object once, since rows sharing a string share its memory.
+    """
+    if isinstance(values, pd.Series) and isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.nbytes + column_bytes(list(values.cat.categories))
+    if isinstance(values, pd.Series) and values.dtype != object:
+        return values.to_numpy().nbytes
+
+    values = list(values)
+    distinct = {id(value): value for value in values}
+    return 8 * len(values) + sum(sys.getsizeof(value) for value in distinct.values())
+
+
+def medicine_ids(keys):
+    """Return the stable ids of rows with the given keys, in row order"""
+    occurrences = Counter()
+    ids = []
+    for key in keys:
+        ids.append(medicine_id(key, occurrences[key]))
+        occurrences[key] += 1
+    return ids
+
+
+class MedicineCatalog:
+    """
+    The medicine dataset together with everything derived from it.
+
+    One instance is shared by the web views and the API so the CSV is parsed
+    once per worker and every index is built once. A catalog can be saved as
+    a snapshot and loaded back with its indexes memory-mapped.
+
+    A catalog is never modified once built: apply_delta() returns a new one.
+    """
+
+    def __init__(self, df, version=None, source_columns=None):
+        """
+        df: cleaned catalog in the dtypes of compact_frame
+        source_columns: columns of the source data, including any lean mode
+        dropped; deltas may still set them
+        """
+        self.df = df
+        self.source_columns = tuple(df.columns if source_columns is None else source_columns)
+        # Identifies this catalog's contents; caches key their entries on it
+        self.version = version or hashlib.sha1(
+            pd.util.hash_pandas_object(df).to_numpy().tobytes()
+        ).hexdigest()[:12]
+        # Names of the delta files applied on top of the source data
+        self.applied_deltas = ()
+        self._rows_by_key = None
+
+        # Stable row ids derived from the medicine's identity, unlike positions
+        # they survive changes to the source file
+        self.ids = medicine_ids(zip(*(df[column].tolist() for column in DELTA_KEY)))
+        self._rows_by_id = None
+
+        # Encoded JSON of full medicine records, filled in as rows are requested
+        self._medicine_json = {}
+        # Ingredient names of rows, filled in as they are asked for
+        self._ingredients = {}
+
+        # Lowercased shadow columns used for matching and filtering
+        self.lowered = {
+            column: shared_strings(df[column].astype(str).str.lower().tolist())
+            for column in SEARCH_COLUMNS
+        }
+
+        # Facet bitmaps for the manufacturer and discontinued filters
+        self.manufacturer_facet = FacetIndex(df['manufacturer'])
+        self.status_facet = FacetIndex(flag_labels('is_discontinued', df['is_discontinued']))
+        self.category_facet = KeywordFacet(self.lowered['uses'], THERAPEUTIC_CATEGORIES)
+
+        self.text_index = TrigramIndex(self.lowered[column] for column in SEARCH_COLUMNS)
+
+        self.ranking_index = BM25Index(
+            {column: self.lowered[column] for column in SEARCH_COLUMNS},
+            RANKING_WEIGHTS
+        )
+
+        # Spelling vocabulary: alphabetic name and composition terms, weighted by
+        # the number of rows they appear in
+        vocabulary = Counter()
+        for column in SPELLING_COLUMNS:
+            for term, postings in self.ranking_index.field_indexes[column].postings.items():
+                if is_spelling_term(term):
+                    vocabulary[term] += len(postings)
+        self.spelling_index = SpellingIndex(vocabulary)
+
+        self.prefix_indexes = {
+            field: PrefixIndex(df[column].unique())
+            for field, column in SUGGEST_FIELDS.items()
+        }
+
+        # Compositions parsed once into ingredients and strengths: rows sharing
+        # ingredients are alternatives, rows with the same signature substitutes
+        components = [self.components(row_id) for row_id in range(len(df))]
+        self.ingredient_index = IngredientIndex([ingredient_names(parsed) for parsed in components])
+        self.substitute_groups = SignatureGroups([signature(parsed) for parsed in components])
+
+        # Every medicine's most similar medicines, computed here once
+        self.similarity_index = SimilarityIndex(
+            similarity_documents(df), SIMILAR_LIMIT, SIMILARITY_MAX_SHARE, SIMILARITY_MIN_ROWS
+        )
+
+    @classmethod
+    def from_csv(cls, path, lean=False):
+        """Load and clean the medicine CSV. lean drops the columns nothing reads."""
+        with open(path, 'rb') as f:
+            raw = f.read()
+
+        df = clean_frame(raw)
+        return cls(compact_frame(df, lean), version=hashlib.sha1(raw).hexdigest()[:12],
+                   source_columns=df.columns)
+
+    @classmethod
+    def from_snapshot(cls, path, lean=False):
+        """Load a catalog saved with save_snapshot, memory-mapping its indexes"""
+        meta, state = snapshot.read_snapshot(path)
+        indexes = state['indexes']
+
+        catalog = cls.__new__(cls)
+        # Snapshot text comes back with equal strings already shared
+        catalog.df = compact_frame(
+            snapshot.decode_frame(meta['columns'], state['columns']), lean, share_strings=False
+        )
+        catalog.source_columns = tuple(column['name'] for column in meta['columns'])
+        catalog.version = meta['version']
+        catalog.applied_deltas = tuple(meta['deltas'])
+        catalog._rows_by_key = None
+        catalog.ids = unpack_strings(indexes['ids'])
+        catalog._rows_by_id = None
+        catalog._medicine_json = {}
+        catalog._ingredients = {}
+        catalog.lowered = {
+            column: snapshot.decode_strings(values).tolist()
+            for column, values in indexes['lowered'].items()
+        }
+        catalog.manufacturer_facet = FacetIndex.from_state(indexes['manufacturer_facet'])
+        catalog.status_facet = FacetIndex.from_state(indexes['status_facet'])
+        catalog.category_facet = KeywordFacet.from_state(indexes['category_facet'])
+        catalog.text_index = TrigramIndex.from_state(
+            indexes['text_index'], (catalog.lowered[column] for column in SEARCH_COLUMNS)
+        )
+        catalog.ranking_index = BM25Index.from_state(indexes['ranking_index'])
+        catalog.spelling_index = SpellingIndex.from_state(indexes['spelling_index'])
+        catalog.prefix_indexes = {
+            field: PrefixIndex.from_state(index_state)
+            for field, index_state in indexes['prefix_indexes'].items()
+        }
+        catalog.ingredient_index = IngredientIndex.from_state(indexes['ingredient_index'])
+        catalog.substitute_groups = SignatureGroups.from_state(indexes['substitute_groups'])
+        catalog.similarity_index = SimilarityIndex.from_state(indexes['similarity_index'])
+        return catalog
+
+    def save_snapshot(self, path, source_path=None):
+        """
+        Write the catalog and its indexes to a snapshot directory. source_path
+        is the file the catalog was loaded from, used to detect stale snapshots.
+        """
+        columns, column_state = snapshot.encode_frame(self.df)
+        indexes = {
+            'ids': pack_strings(self.ids),
+            'lowered': {
+                column: snapshot.encode_strings(values) for column, values in self.lowered.items()
+            },
+            'manufacturer_facet': self.manufacturer_facet.state(),
+            'status_facet': self.status_facet.state(),
+            'category_facet': self.category_facet.state(),
+            'text_index': self.text_index.state(),
+            'ranking_index': self.ranking_index.state(),
+            'spelling_index': self.spelling_index.state(),
+            'prefix_indexes': {
+                field: index.state() for field, index in self.prefix_indexes.items()
+            },
+            'ingredient_index': self.ingredient_index.state(),
+            'substitute_groups': self.substitute_groups.state(),
+            'similarity_index': self.similarity_index.state(),
+        }
+        meta = {
+            'version': self.version,
+            'rows': len(self.df),
+            'columns': columns,
+            'source': snapshot.source_signature(source_path) if source_path else None,
+            'deltas': list(self.applied_deltas),
+        }
+        snapshot.write_snapshot(path, meta, {'columns': column_state, 'indexes': indexes})
+
+    def _row_index(self):
+        """Return the (name, manufacturer) -> row ids map used to match deltas"""
+        if self._rows_by_key is None:
+            rows_by_key = {}
+            keys = zip(*(self.df[column].tolist() for column in DELTA_KEY))
+            for row_id, key in enumerate(keys):
+                rows_by_key.setdefault(key, []).append(row_id)
+            self._rows_by_key = rows_by_key
+        return self._rows_by_key
+
+    def _id_index(self):
+        """Return the stable id -> row id map"""
+        if self._rows_by_id is None:
+            self._rows_by_id = {medicine_id: row_id for row_id, medicine_id in enumerate(self.ids)}
+        return self._rows_by_id
+
+    def _patched_frame(self, patches, added):
+        """Return a copy of the DataFrame with rows patched and new rows appended"""
+        data = {}
+        for column in self.df.columns:
+            series = self.df[column]
+            column_patches = [
+                (row_id, row[column]) for row_id, row in patches.items() if column in row
+            ]
+            if column_patches or added:
+                # Patched as text, like the delta values, then compacted again
+                if column in FLAG_COLUMNS:
+                    values = flag_labels(column, series.to_numpy())
+                else:
+                    values = series.to_numpy(dtype=object)
+                values = np.concatenate([
+                    values,
+                    np.array([record.get(column, np.nan) for record in added], dtype=object)
+                ])
+                for row_id, value in column_patches:
+                    values[row_id] = value
+                series = pd.Series(values)
+                if column in CATEGORY_COLUMNS or column in FLAG_COLUMNS:
+                    series = compact_column(column, series)
+                elif self.df[column].dtype != object:
+                    series = series.infer_objects()
+            data[column] = series
+        return pd.DataFrame(data)
+
+    def apply_delta(self, changes, name=None):
+        """
+        Return a new catalog with a delta applied, and a summary of the delta.
+
+        changes is the output of deltas.read_delta; name identifies the delta
+        file. Only the rows the delta touches are re-indexed: the new catalog
+        shares every unchanged index structure with this one, which stays
+        valid for requests still using it.
+        """
+        size = len(self.df)
+        rows_by_key = dict(self._row_index())
+        patches = {}
+        added = []
+        summary = {'added': 0, 'updated': 0, 'discontinued': 0, 'unmatched': []}
+
+        for action, values in changes:
+            key = tuple(values[column] for column in DELTA_KEY)
+            rows = rows_by_key.get(key)
+            if rows is None:
+                if action == 'add':
+                    rows_by_key[key] = [size + len(added)]
+                    added.append(dict(NEW_MEDICINE_DEFAULTS, **values))
+                    summary['added'] += 1
+                else:
+                    summary['unmatched'].append(
+                        {'action': action, 'name': key[0], 'manufacturer': key[1]}
+                    )
+                continue
+
+            if action == 'discontinue':
+                values = {'is_discontinued': 'Yes'}
+            for row_id in rows:
+                if row_id >= size:
+                    added[row_id - size].update(values)
+                else:
+                    patches.setdefault(row_id, {}).update(values)
+            summary['discontinued' if action == 'discontinue' else 'updated'] += 1
+
+        df = self._patched_frame(patches, added)
+        num_rows = len(df)
+        touched = sorted(patches) + list(range(size, num_rows))
+
+        catalog = copy.copy(self)
+        catalog.df = df
+        catalog.version = hashlib.sha1(f'{self.version}:{changes!r}'.encode()).hexdigest()[:12]
+        catalog.applied_deltas = self.applied_deltas + ((name,) if name else ())
+        catalog._rows_by_key = rows_by_key
+
+        # Keys are never renamed and added keys are new, so existing ids stay put
+        new_ids = [medicine_id(tuple(record[column] for column in DELTA_KEY)) for record in added]
+        catalog.ids = self.ids + new_ids
+        catalog._rows_by_id = None
+        if self._rows_by_id is not None:
+            catalog._rows_by_id = dict(self._rows_by_id)
+            catalog._rows_by_id.update(zip(new_ids, range(size, num_rows)))
+
+        # Rows the delta did not touch encode the same as before
+        touched_rows = set(touched)
+        catalog._medicine_json = {
+            row_id: encoded for row_id, encoded in self._medicine_json.items()
+            if row_id not in touched_rows
+        }
+        catalog._ingredients = {
+            row_id: names for row_id, names in self._ingredients.items()
+            if row_id not in touched_rows
+        }
+
+        catalog.lowered = {}
+        for column in SEARCH_COLUMNS:
+            values = self.lowered[column] + [None] * (num_rows - size)
+            for row_id in touched:
+                values[row_id] = str(df.at[row_id, column]).lower()
+            catalog.lowered[column] = values
+
+        catalog.manufacturer_facet = self.manufacturer_facet.updated(
+            touched, df['manufacturer'].iloc[touched].tolist(), num_rows
+        )
+        catalog.status_facet = self.status_facet.updated(
+            touched, flag_labels('is_discontinued', df['is_discontinued'].to_numpy()[touched]), num_rows
+        )
+        catalog.category_facet = self.category_facet.updated(
+            touched, [catalog.lowered['uses'][row_id] for row_id in touched], num_rows
+        )
+
+        catalog.text_index = self.text_index.updated(
+            (catalog.lowered[column] for column in SEARCH_COLUMNS), touched
+        )
+        catalog.ranking_index = self.ranking_index.updated(
+            {
+                column: {
+                    row_id: (self.lowered[column][row_id] if row_id < size else None,
+                             catalog.lowered[column][row_id])
+                    for row_id in touched
+                }
+                for column in SEARCH_COLUMNS
+            },
+            num_rows
+        )
+        components = {row_id: catalog.components(row_id) for row_id in touched}
+        catalog.ingredient_index = self.ingredient_index.updated(
+            {
+                row_id: (self.ingredients(row_id) if row_id < size else None,
+                         ingredient_names(components[row_id]))
+                for row_id in touched
+            },
+            num_rows
+        )
+        catalog.substitute_groups = self.substitute_groups.updated(
+            {row_id: signature(parsed) for row_id, parsed in components.items()}, num_rows
+        )
+        # Only added rows and rows whose compared text changed affect similarity,
+        # so a delta that only discontinues medicines leaves the table alone
+        old_documents = similarity_documents(self.df.iloc[touched[:len(patches)]])
+        new_documents = similarity_documents(df.iloc[touched])
+        documents = {
+            row_id: document
+            for position, (row_id, document) in enumerate(zip(touched, new_documents))
+            if position >= len(old_documents) or document != old_documents[position]
+        }
+        if documents:
+            catalog.similarity_index = self.similarity_index.updated(documents, num_rows)
+
+        # Spelling terms of the touched rows; old ones are dropped once no name
+        # or composition contains them any more
+        vocabulary = Counter()
+        old_terms = set()
+        for column in SPELLING_COLUMNS:
+            for row_id in touched:
+                vocabulary.update(
+                    term for term in set(tokenize(catalog.lowered[column][row_id]))
+                    if is_spelling_term(term)
+                )
+                if row_id < size:
+                    old_terms.update(tokenize(self.lowered[column][row_id]))
+        catalog.spelling_index = self.spelling_index.updated(vocabulary, [
+            term for term in old_terms
+            if is_spelling_term(term) and not any(
+                term in catalog.ranking_index.field_indexes[column] for column in SPELLING_COLUMNS
+            )
+        ])
+
+        catalog.prefix_indexes = {}
+        for field, column in SUGGEST_FIELDS.items():
+            old_values = set()
+            for row_id in patches:
+                if self.df[column].iat[row_id] != df[column].iat[row_id]:
+                    old_values.add(self.df[column].iat[row_id])
+            catalog.prefix_indexes[field] = self.prefix_indexes[field].updated(
+                df[column].iloc[touched].unique(),
+                [value for value in old_values if not catalog._contains_value(column, value)]
+            )
+        return catalog, summary
+
+    def _contains_value(self, column, value):
+        """Return whether any row has exactly this value in a suggestion column"""
+        if column == 'manufacturer':
+            return len(self.manufacturer_facet.bitmap(str(value))) > 0
+        # Rows with the exact value are among the trigram candidates of its lowercased form
+        row_ids = self.text_index.candidates(str(value).lower())
+        values = self.df[column].to_numpy()
+        if row_ids is not None:
+            values = values[row_ids]
+        return bool((values == value).any())
+
+    def __len__(self):
+        return len(self.df)
+
+    def search(self, query='', manufacturer='', discontinued='all', text_matches=None):
+        """
+        Return the sorted row ids matching a text query and filters.
+
+        query matches name, composition or uses as a substring; manufacturer
+        is a substring filter; discontinued is 'all', 'active' or 'discontinued'.
+        text_matches is an optional dict memoizing query -> text-index matches
+        across calls.
+        """
+        # Combine the filter bitmaps first, then AND them with the text matches
+        filters = None
+        if manufacturer:
+            filters = self.manufacturer_facet.containing(manufacturer)
+        if discontinued in DISCONTINUED_STATES:
+            status = self.status_facet.bitmap(DISCONTINUED_STATES[discontinued])
+            filters = status if filters is None else filters & status
+
+        if not query:
+            if filters is None:
+                return np.arange(len(self.df), dtype=np.int32)
+            return filters.to_ids()
+
+        if text_matches is None:
+            row_ids = self.text_index.match(query)
+        else:
+            if query not in text_matches:
+                text_matches[query] = self.text_index.match(query)
+            row_ids = text_matches[query]
+
+        if filters is None or len(row_ids) == 0:
+            return row_ids
+        return (Bitmap.from_ids(row_ids, len(self.df)) & filters).to_ids()
+
+    def rank(self, query, row_ids, limit, offset=0):
+        """
+        Return up to limit of row_ids ordered by relevance to query, skipping
+        the first offset ranked rows. Without a query, catalog order is kept.
+        """
+        if not query:
+            return row_ids[offset:offset + limit]
+        return self.ranking_index.top_k(query, row_ids, offset + limit)[offset:]
+
+    def composition_text(self, row_id):
+        """
+        Return a row's lowercased composition, or its short compositions
+        joined together when the composition is missing
+        """
+        composition = self.lowered['composition'][row_id]
+        if composition != FILL_VALUES['composition'].lower():
+            return composition
+        return ' + '.join(
+            self.df[column].iat[row_id] for column in SHORT_COMPOSITION_COLUMNS
+            if column in self.df.columns and isinstance(self.df[column].iat[row_id], str)
+        )
+
+    def components(self, row_id):
+        """Return a row's composition as (ingredient, amount, unit) tuples"""
+        return parse_composition(self.composition_text(row_id))
+
+    def ingredients(self, row_id):
+        """Return the ingredient names of a row's composition, parsed on first use"""
+        names = self._ingredients.get(row_id)
+        if names is None:
+            names = self._ingredients[row_id] = ingredient_names(self.components(row_id))
+        return names
+
+    def substitutes(self, row_id, discontinued='all'):
+        """
+        Return the row ids of the other medicines with the same ingredients in
+        the same strengths. discontinued is 'all', 'active' or 'discontinued'.
+        """
+        row_ids = self.substitute_groups.group(row_id)
+        row_ids = row_ids[row_ids != row_id]
+        if discontinued in DISCONTINUED_STATES:
+            flags = self.df['is_discontinued'].to_numpy()[row_ids]
+            row_ids = row_ids[flags == (discontinued == 'discontinued')]
+        return row_ids
+
+    def alternatives(self, row_id, limit=ALTERNATIVES_LIMIT):
+        """
+        Return the row ids of up to limit other medicines sharing ingredients
+        with a row, the most similar ingredient sets first
+        """
+        row_ids, _ = self.ingredient_index.similar(self.ingredients(row_id), limit, exclude=row_id)
+        return row_ids
+
+    def similar(self, row_id, limit=SIMILAR_LIMIT):
+        """
+        Return (row_ids, scores) of up to limit medicines whose uses,
+        composition and side effects are most like a row's, most similar first
+        """
+        row_ids, scores = self.similarity_index.similar(row_id)
+        return row_ids[:limit], scores[:limit]
+
+    def facet_counts(self, row_ids):
+        """Count matching rows per manufacturer, status and therapeutic category"""
+        status_counts = self.status_facet.counts(row_ids)
+        return {
+            'manufacturer': self.manufacturer_facet.counts(row_ids),
+            'status': {
+                state: status_counts.get(value, 0)
+                for state, value in DISCONTINUED_STATES.items()
+            },
+            'category': self.category_facet.counts(Bitmap.from_ids(row_ids, len(self.df))),
+        }
+
+    def search_page(self, query='', manufacturer='', discontinued='all',
+                    limit=50, offset=0, fuzzy=False, facets=False, text_matches=None):
+        """
+        Return one ranked page of results as a SearchPage.
+
+        Pages are cached as row ids, keyed on the normalized request and this
+        catalog's version. With fuzzy set, a query without matches is retried
+        with misspelled words corrected. With facets set, facet counts over
+        the full match set are included. text_matches is passed to search().
+        """
+        query = query.strip().lower()
+        manufacturer = manufacturer.strip().lower()
+        key = (query, manufacturer, discontinued, limit, offset, fuzzy, facets)
+
+        page = search_cache.get(self.version, key)
+        if page is not None:
+            return page
+
+        row_ids = self.search(query, manufacturer, discontinued, text_matches)
+
+        corrected_query = None
+        if fuzzy and query and len(row_ids) == 0:
+            corrected_query = self.correct_query(query)
+            if corrected_query:
+                row_ids = self.search(corrected_query, manufacturer, discontinued, text_matches)
+
+        page = SearchPage(
+            self.rank(corrected_query or query, row_ids, limit, offset),
+            len(row_ids),
+            corrected_query,
+            self.facet_counts(row_ids) if facets else None
+        )
+        search_cache.put(self.version, key, page)
+        return page
+
+    def search_batch(self, requests):
+        """
+        Run many searches at once. requests is a list of search_page keyword
+        dicts; the SearchPages are returned in the same order.
+
+        Text-index matches are shared between requests with the same query and
+        every page still goes through the result cache.
+        """
+        text_matches = {}
+        return [self.search_page(text_matches=text_matches, **request) for request in requests]
+
+    def correct_query(self, query):
+        """Return the query with misspelled words corrected, or None"""
+        return self.spelling_index.correct(query.lower())
+
+    def suggest(self, prefix, limit=10):
+        """Return up to limit completions of prefix for each suggestion field"""
+        return {
+            field: index.complete(prefix, limit)
+            for field, index in self.prefix_indexes.items()
+        }
+
+    def parse_fields(self, value):
+        """
+        Parse a comma-separated fields parameter into column names. Returns
+        None (all columns) for an empty value; raises ValueError for unknown
+        fields.
+        """
+        if not value:
+            return None
+
+        fields = [field.strip() for field in value.split(',') if field.strip()]
+        unknown = [
+            field for field in fields if field not in self.df.columns and field not in RECORD_KEYS
+        ]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+        return [field for field in dict.fromkeys(fields) if field not in RECORD_KEYS]
+
+    def _columns(self, fields):
+        """Return the column positions for a list of field names"""
+        return [self.df.columns.get_loc(field) for field in fields]
+
+    def resolve(self, key):
+        """
+        Return the row id of a medicine given its stable id or, for
+        compatibility, its positional index. Returns None if there is no such
+        medicine.
+        """
+        row_id = self._id_index().get(key) if isinstance(key, str) else None
+        if row_id is None:
+            try:
+                row_id = int(key)
+            except (TypeError, ValueError):
+                return None
+            if row_id < 0 or row_id >= len(self.df):
+                return None
+        return row_id
+
+    def _flag_labels(self, fields):
+        """Return (column, labels) for the flag columns among fields"""
+        return [
+            (column, FLAG_COLUMNS[column])
+            for column in (self.df.columns if fields is None else fields)
+            if column in FLAG_COLUMNS
+        ]
+
+    def records(self, row_ids, fields=None):
+        """
+        Convert the given rows to a list of dictionaries, tagged with their
+        stable id and index. fields restricts the columns before conversion.
+        """
+        if fields is None:
+            records = self.df.iloc[row_ids].to_dict('records')
+        elif not fields:
+            # Only id and index asked for: a frame without columns has no records
+            records = [{} for _ in row_ids]
+        else:
+            records = self.df.iloc[row_ids, self._columns(fields)].to_dict('records')
+        flags = self._flag_labels(fields)
+        for row_id, record in zip(row_ids, records):
+            for column, labels in flags:
+                record[column] = labels[bool(record[column])]
+            record['id'] = self.ids[row_id]
+            record['index'] = int(row_id)
+        return records
+
+    def iter_records(self, row_ids, chunk_size=1000, fields=None):
+        """Yield the given rows as lists of dictionaries, chunk_size rows at a time"""
+        for start in range(0, len(row_ids), chunk_size):
+            yield self.records(row_ids[start:start + chunk_size], fields)
+
+    def records_by_id(self, row_ids):
+        """Convert the given rows to dictionaries with one lookup, keyed by row id"""
+        unique_ids = np.unique(np.asarray(row_ids, dtype=np.int32))
+        return {record['index']: record for record in self.records(unique_ids)}
+
+    def get_many(self, keys, fields=None):
+        """
+        Resolve many stable ids or indices, then take their rows at once.
+
+        Returns (records, missing): the records of the medicines found in
+        request order, and the requested keys that do not exist.
+        """
+        row_ids = [self.resolve(key) for key in keys]
+        found = np.array([row_id for row_id in row_ids if row_id is not None], dtype=np.int64)
+        missing = [key for key, row_id in zip(keys, row_ids) if row_id is None]
+        return self.records(found, fields), missing
+
+    def get(self, key, fields=None):
+        """
+        Return one medicine, given its stable id or index, as a dictionary
+        tagged with its stable id and index, or None if there is no such medicine.
+        fields restricts the columns returned.
+        """
+        row_id = self.resolve(key)
+        if row_id is None:
+            return None
+        if fields is None:
+            # Decoding the cached JSON is cheaper than converting the row again
+            return json.loads(self.medicine_json(row_id))
+        return self._medicine(row_id, fields)
+
+    def medicine_json(self, row_id):
+        """
+        Return the full record of a row as JSON bytes, encoded on first use.
+        Keys are sorted and separators compact, as in the API's responses.
+        """
+        encoded = self._medicine_json.get(row_id)
+        if encoded is None:
+            encoded = json.dumps(self._medicine(row_id), sort_keys=True, separators=(',', ':')).encode()
+            self._medicine_json[row_id] = encoded
+        return encoded
+
+    def etag(self, row_id, fields=None):
+        """
+        Return a strong ETag for a row's record. Rows only change along with
+        the catalog version; fields tells projected representations apart.
+        """
+        tag = f'{self.version}-{self.ids[row_id]}'
+        if fields is not None:
+            tag += '-' + hashlib.sha1(','.join(fields).encode()).hexdigest()[:8]
+        return tag
+
+    def _medicine(self, row_id, fields=None):
+        """Convert one row to a dictionary tagged with its stable id and index"""
+        if fields is None:
+            medicine = self.df.iloc[row_id].to_dict()
+        else:
+            medicine = self.df.iloc[row_id, self._columns(fields)].to_dict()
+        for column, labels in self._flag_labels(fields):
+            medicine[column] = labels[bool(medicine[column])]
+        medicine['id'] = self.ids[row_id]
+        medicine['index'] = int(row_id)
+        return medicine
+
+
+def encode_cursor(offset):
+    """Encode a result offset as an opaque pagination cursor"""
+    return base64.urlsafe_b64encode(json.dumps({'offset': offset}).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode a pagination cursor, raising ValueError if it is malformed"""
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(cursor.encode()))['offset']
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError('Invalid cursor') from e
+
+    if not isinstance(offset, int) or offset < 0:
+        raise ValueError('Invalid cursor')
+    return offset
+
+
+def page_offset(page, cursor, page_size):
+    """
+    Return the result offset for a request: a cursor wins over a 1-based page
+    number. Raises ValueError for an invalid cursor or page.
+    """
+    if cursor:
+        return decode_cursor(cursor)
+    if page < 1:
+        raise ValueError('Invalid page')
+    return (page - 1) * page_size
+
+
+def apply_pending_deltas(catalog, delta_directory=None):
+    """
+    Apply the delta files that catalog does not include yet, in order.
+    Returns the updated catalog and a summary per applied file.
+    """
+    delta_directory = Config.CATALOG_DELTA_DIR if delta_directory is None else delta_directory
+
+    summaries = []
+    for name in list_deltas(delta_directory):
+        if name in catalog.applied_deltas:
+            continue
+        changes = read_delta(os.path.join(delta_directory, name), catalog.source_columns)
+        catalog, summary = catalog.apply_delta(changes, name)
+        summaries.append(dict(summary, file=name))
+    return catalog, summaries
+
+
+def load_catalog(source_path=None, snapshot_path=None, delta_directory=None):
+    """
+    Load the catalog from its snapshot when one is up to date with the source
+    CSV, and from the CSV otherwise, then apply pending delta files. Paths
+    default to the configured ones.
+    """
+    source_path = source_path or Config.CATALOG_PATH
+    snapshot_path = Config.CATALOG_SNAPSHOT_PATH if snapshot_path is None else snapshot_path
+
+    if snapshot_path and snapshot.is_current(snapshot_path, source_path):
+        catalog = MedicineCatalog.from_snapshot(snapshot_path, Config.CATALOG_LEAN)
+    else:
+        if snapshot_path and snapshot.read_meta(snapshot_path) is not None:
+            logger.warning('Catalog snapshot %s is stale; loading %s instead', snapshot_path, source_path)
+        catalog = MedicineCatalog.from_csv(source_path, Config.CATALOG_LEAN)
+
+    catalog, _ = apply_pending_deltas(catalog, delta_directory)
+    return catalog
+
+
+def catalog_signature(source_path=None, snapshot_path=None, delta_directory=None):
+    """
+    Return a value that changes whenever the catalog files change: the source
+    CSV's size and modification time, the snapshot's version, if any, and the
+    names of the delta files.
+    """
+    source_path = source_path or Config.CATALOG_PATH
+    snapshot_path = Config.CATALOG_SNAPSHOT_PATH if snapshot_path is None else snapshot_path
+    delta_directory = Config.CATALOG_DELTA_DIR if delta_directory is None else delta_directory
+
+    source = snapshot.source_signature(source_path) if os.path.exists(source_path) else None
+    meta = snapshot.read_meta(snapshot_path) if snapshot_path else None
+    return source, meta and meta['version'], tuple(list_deltas(delta_directory))
+
+
+class CatalogReloader:
+    """
+    Holds the live catalog and replaces it without downtime.
+
+    A reload loads the new catalog and builds its indexes in a background
+    thread while requests keep using the current one, then swaps the
+    reference in a single assignment. Requests that already fetched the old
+    catalog finish against it, and it is freed once the last one drops it.
+    Caches keyed on the catalog version roll over on their own.
+
+    New delta files are applied incrementally to the live catalog instead of
+    reloading it. Applying deltas and swapping in a reloaded catalog are
+    serialized, so neither replaces the other's catalog with a stale one.
+    """
+
+    def __init__(self, loader=load_catalog):
+        self.loader = loader
+        self.catalog = None
+        self.signature = None
+        self.loaded_at = None
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._delta_lock = threading.Lock()
+        self._thread = None
+        self._watcher = None
+
+    def get(self):
+        """Return the live catalog, loading it on first use"""
+        if self.catalog is None:
+            with self._lock:
+                if self.catalog is None:
+                    self._swap(catalog_signature(), self.loader())
+        return self.catalog
+
+    def _swap(self, signature, catalog):
+        self.catalog = catalog
+        self.signature = signature
+        self.loaded_at = datetime.utcnow()
+        self.last_error = None
+
+    def reload(self):
+        """Load a new catalog and swap it in; returns the new catalog"""
+        # Taken before loading, so changes made during the load trigger another reload
+        signature = catalog_signature()
+        catalog = self.loader()
+        # Deltas applied to the live catalog during the load must not be lost:
+        # catch up on them and swap while no delta can be applied
+        with self._delta_lock:
+            deltas = catalog_signature()[2]
+            catalog, _ = apply_pending_deltas(catalog)
+            with self._lock:
+                self._swap(signature[:2] + (deltas,), catalog)
+        search_cache.clear()
+        logger.info('Catalog reloaded: version %s, %d medicines', catalog.version, len(catalog))
+        return catalog
+
+    def apply_deltas(self):
+        """
+        Apply pending delta files to the live catalog and swap the result in.
+        Returns a summary per applied file. Raises ValueError for a malformed
+        delta file, leaving the live catalog unchanged.
+        """
+        with self._delta_lock:
+            deltas = catalog_signature()[2]
+            catalog, summaries = apply_pending_deltas(self.get())
+            with self._lock:
+                signature = self.signature[:2] + (deltas,)
+                if summaries:
+                    self._swap(signature, catalog)
+                    logger.info('Applied %d catalog deltas: version %s', len(summaries), catalog.version)
+                else:
+                    self.signature = signature
+        return summaries
+
+    def _reload_in_background(self):
+        try:
+            self.reload()
+        except Exception as e:
+            # Keep serving the current catalog; the error is reported by status()
+            logger.exception('Catalog reload failed')
+            self.last_error = str(e)
+
+    def start_reload(self):
+        """Start a background reload. Returns False if one is already running."""
+        with self._lock:
+            if self.reloading:
+                return False
+            self._thread = threading.Thread(
+                target=self._reload_in_background, name='catalog-reload', daemon=True
+            )
+            self._thread.start()
+            return True
+
+    @property
+    def reloading(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def watch(self, interval):
+        """
+        Poll the catalog files every interval seconds. Changes to the CSV or
+        snapshot reload the catalog; new delta files are applied to it.
+        """
+        if self._watcher is not None:
+            return
+
+        def poll():
+            # A failed update is retried only once the files change again
+            attempted = None
+            while True:
+                time.sleep(interval)
+                try:
+                    signature = catalog_signature()
+                except OSError:
+                    continue
+                if signature in (self.signature, attempted):
+                    continue
+
+                if signature[:2] != self.signature[:2]:
+                    if self.start_reload():
+                        attempted = signature
+                    continue
+
+                attempted = signature
+                try:
+                    self.apply_deltas()
+                except (OSError, ValueError) as e:
+                    logger.exception('Applying catalog deltas failed')
+                    self.last_error = str(e)
+
+        self._watcher = threading.Thread(target=poll, name='catalog-watch', daemon=True)
+        self._watcher.start()
+
+    def status(self):
+        """Return the live catalog's version and the state of reloads"""
+        catalog = self.catalog
+        return {
+            'version': catalog.version if catalog is not None else None,
+            'medicines': len(catalog) if catalog is not None else 0,
+            'loaded_at': self.loaded_at.isoformat() if self.loaded_at else None,
+            'reloading': self.reloading,
+            'last_error': self.last_error,
+        }
+
+
+catalog_reloader = CatalogReloader()
+
+
+def get_catalog():
+    """
+    Return the live catalog, loading it on first use. Views should call this
+    once per request and keep the result, so a reload cannot mix versions.
+    """
+    return catalog_reloader.get()
+
+
+def memory_report(source_path, lean=False):
+    """
+    Return (column, bytes before, bytes after) rows comparing the CSV as
+    parsed with the compacted catalog, including the lowercased copies of
+    the search columns. Dropped columns have 0 bytes after.
+    """
+    with open(source_path, 'rb') as f:
+        df = clean_frame(f.read())
+    compacted = compact_frame(df, lean)
+
+    rows = [
+        (column, column_bytes(df[column]),
+         column_bytes(compacted[column]) if column in compacted.columns else 0)
+        for column in df.columns
+    ]
+    for column in SEARCH_COLUMNS:
+        lowered = df[column].astype(str).str.lower().tolist()
+        rows.append((f'{column} (lowercased)', column_bytes(lowered),
+                     column_bytes(shared_strings(lowered))))
+    return rows
+
+
+def print_memory_report(source_path, lean=False):
+    """Print memory_report as a table"""
+    rows = memory_report(source_path, lean)
+    rows.append(('total', sum(row[1] for row in rows), sum(row[2] for row in rows)))
+
+    width = max(len(row[0]) for row in rows)
+    print(f"{'column':<{width}}  {'before':>12}  {'after':>12}  {'saved':>6}")
+    for column, before, after in rows:
+        saved = 1 - after / before if before else 0
+        print(f'{column:<{width}}  {before:>12,}  {after:>12,}  {saved:>6.0%}')
+
+
+def main(argv=None):
+    """Command-line catalog tools"""
+    parser = argparse.ArgumentParser(prog='catalog', description='Medicine catalog tools')
+    parser.add_argument('--build-snapshot', action='store_true',
+                        help='build the catalog and its indexes and write them to a snapshot')
+    parser.add_argument('--source', default=Config.CATALOG_PATH,
+                        help='catalog CSV (default: %(default)s)')
+    parser.add_argument('--output', default=Config.CATALOG_SNAPSHOT_PATH,
+                        help='snapshot directory (default: %(default)s)')
+    parser.add_argument('--deltas', default=Config.CATALOG_DELTA_DIR,
+                        help='delta files to apply before writing (default: %(default)s)')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='print the memory used by each catalog column before and after compaction')
+    parser.add_argument('--lean', action='store_true', default=Config.CATALOG_LEAN,
+                        help='report on a lean catalog, without the columns nothing reads')
+    args = parser.parse_args(argv)
+
+    if args.memory_report:
+        print_memory_report(args.source, args.lean)
+        return 0
+
+    if not args.build_snapshot:
+        parser.print_help()
+        return 1
+
+    started = time.perf_counter()
+    catalog, _ = apply_pending_deltas(MedicineCatalog.from_csv(args.source), args.deltas)
+    catalog.save_snapshot(args.output, args.source)
+    print(f'Wrote snapshot of {len(catalog)} medicines (version {catalog.version}) '
+          f'to {args.output} in {time.perf_counter() - started:.1f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
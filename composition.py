@@ -0,0 +1,267 @@
+"""
+Medicine compositions: parsing them into ingredients and strengths, indexing
+rows by ingredient to find medicines with similar compositions, and grouping
+rows with identical compositions
+"""
+import copy
+import hashlib
+import re
+from collections import defaultdict
+
+import numpy as np
+
+from search_index import EMPTY_POSTINGS, PackedPostings, pack_strings, unpack_strings
+
+# Strengths and other parenthesized details, e.g. "(500mg)"
+PARENTHESIZED = re.compile(r'\(([^)]*)\)')
+
+# A strength such as "500mg", "0.5 %", "10,000 IU" or "125mg/5ml"
+STRENGTH = re.compile(r'(\d[\d,]*(?:\.\d+)?)\s*([a-zµ%]+(?:\s*/\s*[\d.]*\s*[a-z]+)?)')
+
+# The same at the end of an ingredient written without parentheses
+TRAILING_STRENGTH = re.compile(STRENGTH.pattern + r'$')
+
+# Units converted to another unit, with the factor to multiply amounts by
+UNIT_CONVERSIONS = {
+    'g': ('mg', 1000.0),
+    'gm': ('mg', 1000.0),
+    'mcg': ('mg', 0.001),
+    'µg': ('mg', 0.001),
+    'ug': ('mg', 0.001),
+}
+
+
+def canonical_strength(amount, unit):
+    """Return (amount, unit) with the unit converted to its canonical form"""
+    unit = ''.join(unit.split())
+    base, _, per = unit.partition('/')
+    if base in UNIT_CONVERSIONS:
+        base, factor = UNIT_CONVERSIONS[base]
+        amount *= factor
+    return round(amount, 6), f'{base}/{per}' if per else base
+
+
+def parse_component(text):
+    """
+    Parse one ingredient such as 'Paracetamol (500mg)' or 'Paracetamol 500mg'
+    into (ingredient, amount, unit), or None if there is no ingredient name.
+    amount is None and unit empty when no strength is given.
+    """
+    text = text.lower()
+    strength = None
+    for details in PARENTHESIZED.findall(text):
+        strength = STRENGTH.search(details)
+        if strength:
+            break
+    name = ' '.join(PARENTHESIZED.sub(' ', text).split())
+
+    if strength is None:
+        strength = TRAILING_STRENGTH.search(name)
+        if strength:
+            name = name[:strength.start()].rstrip()
+
+    name = name.strip(' .,;:-')
+    if not name:
+        return None
+    if strength is None:
+        return name, None, ''
+    return (name, *canonical_strength(float(strength.group(1).replace(',', '')), strength.group(2)))
+
+
+def parse_composition(composition):
+    """
+    Parse a composition such as 'Amoxycillin (500mg) + Clavulanic Acid
+    (125mg)' into canonical (ingredient, amount, unit) tuples, in order of
+    appearance and without repeats.
+    """
+    components = []
+    for part in composition.split('+'):
+        component = parse_component(part)
+        if component is not None and component not in components:
+            components.append(component)
+    return components
+
+
+def ingredient_names(components):
+    """Return the distinct ingredient names of parsed components, in order"""
+    return tuple(dict.fromkeys(name for name, _, _ in components))
+
+
+def signature(components):
+    """
+    Return a hash identifying a set of (ingredient, amount, unit) components
+    regardless of their order, or None for no components.
+    """
+    if not components:
+        return None
+    canonical = sorted({
+        name if amount is None else f'{name}:{amount:g}{unit}'
+        for name, amount, unit in components
+    })
+    return hashlib.sha1('+'.join(canonical).encode()).hexdigest()[:16]
+
+
+class IngredientIndex:
+    """
+    Ingredient -> sorted row ids, plus the number of distinct ingredients in
+    every row, so rows can be ranked by the ingredients they share with a
+    composition without looking at any other row.
+    """
+
+    def __init__(self, compositions):
+        """
+        compositions: sequence of per-row ingredient tuples from ingredient_names()
+        """
+        self.sizes = np.zeros(len(compositions), dtype=np.int16)
+        postings = defaultdict(list)
+        for row_id, names in enumerate(compositions):
+            self.sizes[row_id] = len(names)
+            for name in names:
+                postings[name].append(row_id)
+        self.postings = PackedPostings.from_lists(postings)
+
+    def similar(self, names, limit, exclude=None):
+        """
+        Return (row_ids, scores) of up to limit rows sharing ingredients with
+        names, most similar first. The score is the Jaccard similarity of the
+        two ingredient sets; ties go to the earlier row. exclude is a row id
+        left out of the results.
+        """
+        postings = [ids for ids in map(self.postings.get, names) if ids is not None]
+        if not postings:
+            return EMPTY_POSTINGS, np.empty(0)
+
+        # A row's overlap is the number of the ingredients' postings it appears in
+        row_ids, overlap = np.unique(np.concatenate(postings), return_counts=True)
+        scores = overlap / (len(names) + self.sizes[row_ids] - overlap)
+        if exclude is not None:
+            keep = row_ids != exclude
+            row_ids, scores = row_ids[keep], scores[keep]
+
+        order = np.lexsort((row_ids, -scores))[:limit]
+        return row_ids[order], scores[order]
+
+    def updated(self, changes, num_rows):
+        """
+        Return a copy reflecting changed and added rows.
+
+        changes: mapping of row id -> (old ingredients, or None for a new row,
+        new ingredients)
+        num_rows: number of rows after the change
+        """
+        sizes = np.zeros(num_rows, dtype=np.int16)
+        sizes[:len(self.sizes)] = self.sizes
+
+        removals = defaultdict(list)
+        additions = defaultdict(list)
+        for row_id, (old_names, new_names) in changes.items():
+            old_names = set(old_names or ())
+            sizes[row_id] = len(new_names)
+            for name in old_names.difference(new_names):
+                removals[name].append(row_id)
+            for name in set(new_names).difference(old_names):
+                additions[name].append(row_id)
+
+        index = copy.copy(self)
+        index.sizes = sizes
+        index.postings = self.postings.updated(removals, additions)
+        return index
+
+    def state(self):
+        return {'sizes': self.sizes, 'postings': self.postings.state()}
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls.__new__(cls)
+        index.sizes = state['sizes']
+        index.postings = PackedPostings.from_state(state['postings'])
+        return index
+
+
+class SignatureGroups:
+    """
+    Rows grouped by composition signature.
+
+    Every row has the code of its group (-1 for rows without a signature),
+    and the rows of each group are a slice of one array sorted by group, so
+    the rows sharing a row's composition are found without hashing anything.
+    """
+
+    def __init__(self, signatures):
+        """
+        signatures: per-row signature, or None
+        """
+        codes_by_signature = {}
+        codes = np.full(len(signatures), -1, dtype=np.int32)
+        for row_id, row_signature in enumerate(signatures):
+            if row_signature is not None:
+                codes[row_id] = codes_by_signature.setdefault(row_signature, len(codes_by_signature))
+        self._set_state(list(codes_by_signature), codes)
+
+    def _set_state(self, signatures, codes, order=None, offsets=None):
+        self.signatures = signatures
+        self.codes = codes
+        if order is None:
+            grouped = codes >= 0
+            order = np.flatnonzero(grouped)[np.argsort(codes[grouped], kind='stable')]
+            offsets = np.zeros(len(signatures) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(codes[grouped], minlength=len(signatures)), out=offsets[1:])
+        # Row ids sorted by group; offsets[code]:offsets[code + 1] spans a group
+        self.order = order.astype(np.int32, copy=False)
+        self.offsets = offsets
+
+    def signature(self, row_id):
+        """Return the signature of a row, or None"""
+        code = self.codes[row_id]
+        return None if code < 0 else self.signatures[code]
+
+    def group(self, row_id):
+        """Return the sorted row ids with the same signature as a row, including it"""
+        code = self.codes[row_id]
+        if code < 0:
+            return EMPTY_POSTINGS
+        return self.order[self.offsets[code]:self.offsets[code + 1]]
+
+    def updated(self, signatures, num_rows):
+        """
+        Return a copy with the signatures of some rows replaced.
+
+        signatures: mapping of row id -> new signature, or None
+        num_rows: number of rows after the change; rows past the current
+        size are new
+        """
+        codes = np.full(num_rows, -1, dtype=np.int32)
+        codes[:len(self.codes)] = self.codes
+        group_signatures = list(self.signatures)
+        codes_by_signature = None
+        for row_id, row_signature in signatures.items():
+            if row_signature is None:
+                codes[row_id] = -1
+                continue
+            if codes_by_signature is None:
+                codes_by_signature = {value: code for code, value in enumerate(group_signatures)}
+            code = codes_by_signature.get(row_signature)
+            if code is None:
+                code = codes_by_signature[row_signature] = len(group_signatures)
+                group_signatures.append(row_signature)
+            codes[row_id] = code
+
+        groups = SignatureGroups.__new__(SignatureGroups)
+        groups._set_state(group_signatures, codes)
+        return groups
+
+    def state(self):
+        return {
+            'signatures': pack_strings(self.signatures),
+            'codes': self.codes,
+            'order': self.order,
+            'offsets': self.offsets,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        groups = cls.__new__(cls)
+        groups._set_state(
+            unpack_strings(state['signatures']), state['codes'], state['order'], state['offsets']
+        )
+        return groups
@@ -11,6 +11,48 @@ class Config:
         'sqlite:///' + os.path.join(os.path.dirname(__file__), 'medicine_search.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
+    # Medicine catalog
+    CATALOG_PATH = os.environ.get('CATALOG_PATH') or \
+        os.path.join(os.path.dirname(__file__), 'data', 'medicines_sample.csv')
+    # Snapshot written by `python catalog.py --build-snapshot`; used instead of
+    # the CSV while it is up to date. Set to an empty string to disable.
+    CATALOG_SNAPSHOT_PATH = os.environ.get('CATALOG_SNAPSHOT_PATH',
+        os.path.join(os.path.dirname(__file__), 'data', 'medicines.snapshot'))
+    # Delta CSVs (add/update/discontinue) applied on top of the catalog, in
+    # file-name order. Set to an empty string to disable.
+    CATALOG_DELTA_DIR = os.environ.get('CATALOG_DELTA_DIR',
+        os.path.join(os.path.dirname(__file__), 'data', 'deltas'))
+    # Lean mode drops catalog columns the application never reads (such as
+    # image_url) to save memory; they are then missing from API responses too
+    CATALOG_LEAN = os.environ.get('CATALOG_LEAN', 'False').lower() == 'true'
+    
+    # Pairwise drug interactions: a CSV of ingredient_a, ingredient_b,
+    # severity (high, medium or low) and message
+    INTERACTIONS_PATH = os.environ.get('INTERACTIONS_PATH') or \
+        os.path.join(os.path.dirname(__file__), 'data', 'interactions.csv')
+    
+    # Seconds between checks of the catalog and interaction files for changes;
+    # 0 disables the watchers. Reloads can also be started with
+    # POST /api/v1/admin/catalog/reload and POST /api/v1/admin/interactions/reload.
+    CATALOG_WATCH_INTERVAL = int(os.environ.get('CATALOG_WATCH_INTERVAL', 0))
+    
+    # Token expected in the X-Admin-Token header of admin API requests;
+    # admin endpoints are disabled while it is unset
+    ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+    
+    # Search pagination
+    SEARCH_PAGE_SIZE = 20  # results per page in the web view
+    SEARCH_MAX_PAGE_SIZE = 200  # largest page the API will return
+    SEARCH_BATCH_MAX_QUERIES = 300  # queries accepted by one batch search request
+    MULTI_GET_MAX_IDS = 200  # medicines fetched by one multi-get request
+    
+    # Rows converted per chunk when streaming NDJSON responses
+    EXPORT_CHUNK_SIZE = 1000
+    
+    # Search result cache
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 1024))  # entries
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 300))  # seconds
+    
     # Upload settings
     UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
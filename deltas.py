@@ -0,0 +1,80 @@
+"""
+Catalog delta files: incremental add/update/discontinue changes
+
+A delta is a CSV with an action column plus catalog columns. Each row names
+one medicine by its name and manufacturer:
+
+- add: a new medicine; columns left out or empty get the usual placeholders.
+  Adding a medicine that already exists updates it instead.
+- update: non-empty columns replace the medicine's current values.
+- discontinue: marks the medicine as discontinued.
+
+Delta files are kept in a directory and applied in file-name order.
+"""
+import hashlib
+import os
+from datetime import datetime
+
+import pandas as pd
+
+DELTA_ACTIONS = ('add', 'update', 'discontinue')
+
+# Columns identifying the medicine a delta row applies to
+DELTA_KEY = ('name', 'manufacturer')
+
+
+def read_delta(source, columns):
+    """
+    Read and validate a delta CSV from a path or file object. columns are the
+    catalog columns a delta may set. Returns a list of (action, values) pairs
+    where values maps column -> new value, leaving out empty cells. Raises
+    ValueError for a malformed delta.
+    """
+    try:
+        delta = pd.read_csv(source, dtype=str, keep_default_na=False)
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as e:
+        raise ValueError(f'Invalid delta CSV: {e}') from e
+
+    required = ('action',) + DELTA_KEY
+    missing = [column for column in required if column not in delta.columns]
+    if missing:
+        raise ValueError(f"Delta is missing columns: {', '.join(missing)}")
+
+    unknown = [column for column in delta.columns if column != 'action' and column not in columns]
+    if unknown:
+        raise ValueError(f"Unknown delta columns: {', '.join(unknown)}")
+
+    changes = []
+    for line, row in enumerate(delta.to_dict('records'), start=2):
+        action = row.pop('action').strip().lower()
+        if action not in DELTA_ACTIONS:
+            raise ValueError(f"Line {line}: unknown action '{action}'")
+
+        values = {column: value.strip() for column, value in row.items() if value.strip()}
+        if any(column not in values for column in DELTA_KEY):
+            raise ValueError(f"Line {line}: {' and '.join(DELTA_KEY)} are required")
+        changes.append((action, values))
+    return changes
+
+
+def list_deltas(directory):
+    """Return the names of the delta files in directory, in the order they apply"""
+    if not directory or not os.path.isdir(directory):
+        return []
+    return sorted(name for name in os.listdir(directory) if name.endswith('.csv'))
+
+
+def save_delta(directory, data):
+    """
+    Store raw delta CSV bytes in directory under a name that sorts after the
+    existing deltas, and return the name.
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{hashlib.sha1(data).hexdigest()[:8]}.csv"
+
+    # Written under a temporary name first so a half-written file is never applied
+    temporary = os.path.join(directory, name + '.tmp')
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, os.path.join(directory, name))
+    return name
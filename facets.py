@@ -0,0 +1,247 @@
+"""
+Bitmap row sets and per-value facet indexes for catalog filtering
+"""
+import numpy as np
+import pandas as pd
+
+# Number of set bits in every possible byte value
+POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+
+class Bitmap:
+    """Fixed-size set of row ids stored as a NumPy packed bit array"""
+
+    __slots__ = ('bits', 'size')
+
+    def __init__(self, bits, size):
+        self.bits = bits
+        self.size = size
+
+    @classmethod
+    def from_mask(cls, mask):
+        """Build a bitmap from a boolean array with one entry per row"""
+        return cls(np.packbits(mask), len(mask))
+
+    @classmethod
+    def from_ids(cls, row_ids, size):
+        """Build a bitmap from an array of row ids"""
+        mask = np.zeros(size, dtype=bool)
+        mask[row_ids] = True
+        return cls.from_mask(mask)
+
+    @classmethod
+    def full(cls, size):
+        """Bitmap containing every row"""
+        return cls.from_mask(np.ones(size, dtype=bool))
+
+    @classmethod
+    def empty(cls, size):
+        """Bitmap containing no rows"""
+        return cls(np.zeros((size + 7) // 8, dtype=np.uint8), size)
+
+    def __and__(self, other):
+        return Bitmap(np.bitwise_and(self.bits, other.bits), self.size)
+
+    def __or__(self, other):
+        return Bitmap(np.bitwise_or(self.bits, other.bits), self.size)
+
+    def __len__(self):
+        return int(POPCOUNT[self.bits].sum(dtype=np.int64))
+
+    def to_mask(self):
+        """Return the bitmap as a boolean array with one entry per row"""
+        return np.unpackbits(self.bits, count=self.size).astype(bool)
+
+    def to_ids(self):
+        """Return the sorted row ids in the bitmap"""
+        return np.flatnonzero(np.unpackbits(self.bits, count=self.size)).astype(np.int32)
+
+
+def union(bitmaps, size):
+    """OR a sequence of bitmaps together"""
+    bitmaps = list(bitmaps)
+    if not bitmaps:
+        return Bitmap.empty(size)
+    return Bitmap(np.bitwise_or.reduce([bitmap.bits for bitmap in bitmaps]), size)
+
+
+def bit_positions(row_ids):
+    """Return the byte index and bit mask of each row id in a packed bit array"""
+    row_ids = np.asarray(row_ids, dtype=np.int64)
+    return row_ids >> 3, (0x80 >> (row_ids & 7)).astype(np.uint8)
+
+
+def resized(bits, size):
+    """Copy a 2-D packed bit matrix, padding its rows to hold size rows"""
+    copied = np.zeros((bits.shape[0], (size + 7) // 8), dtype=np.uint8)
+    copied[:, :bits.shape[1]] = bits
+    return copied
+
+
+def bitmap_rows(bits, size):
+    """Wrap each row of a 2-D packed bit matrix as a Bitmap, without copying"""
+    return [Bitmap(row, size) for row in bits]
+
+
+class FacetIndex:
+    """
+    One bitmap per distinct value of a categorical column.
+
+    Also keeps the column as integer codes into labels, for counting.
+    """
+
+    def __init__(self, values):
+        codes, labels = pd.factorize(pd.Series(values).astype(str), sort=True)
+        codes = codes.astype(np.int32)
+
+        # Group row ids by code with one stable sort instead of a scan per value
+        order = np.argsort(codes, kind='stable')
+        boundaries = np.searchsorted(codes[order], np.arange(len(labels) + 1))
+        bits = np.zeros((len(labels), (len(codes) + 7) // 8), dtype=np.uint8)
+        for code in range(len(labels)):
+            bits[code] = Bitmap.from_ids(order[boundaries[code]:boundaries[code + 1]], len(codes)).bits
+
+        self._set_state(codes, list(labels), bits)
+
+    def _set_state(self, codes, labels, bits):
+        self.size = len(codes)
+        self.codes = codes
+        self.labels = labels
+        self.labels_lower = [label.lower() for label in labels]
+        # One row of packed bits per label, in label order
+        self.bits = bits
+        self.bitmaps = dict(zip(labels, bitmap_rows(bits, self.size)))
+
+    def counts(self, row_ids):
+        """Count the given rows per value in one pass, largest counts first"""
+        counts = np.bincount(self.codes[row_ids], minlength=len(self.labels))
+        nonzero = np.flatnonzero(counts)
+        order = nonzero[np.argsort(-counts[nonzero], kind='stable')]
+        return {self.labels[code]: int(counts[code]) for code in order}
+
+    def bitmap(self, label):
+        """Return the bitmap of rows with exactly this value"""
+        return self.bitmaps.get(label, Bitmap.empty(self.size))
+
+    def containing(self, substring):
+        """Return the bitmap of rows whose value contains substring, ignoring case"""
+        substring = substring.lower()
+        return union(
+            (self.bitmaps[label]
+             for label, lowered in zip(self.labels, self.labels_lower)
+             if substring in lowered),
+            self.size
+        )
+
+    def updated(self, row_ids, values, size):
+        """
+        Return a copy with the given rows set to new values. size is the
+        number of rows afterwards; rows past the current size are new. Labels
+        left without rows are dropped.
+        """
+        values = [str(value) for value in values]
+        labels = sorted(set(self.labels).union(values))
+        code_of = {label: code for code, label in enumerate(labels)}
+
+        codes = np.zeros(size, dtype=np.int32)
+        bits = np.zeros((len(labels), (size + 7) // 8), dtype=np.uint8)
+        if len(labels) == len(self.labels):
+            codes[:self.size] = self.codes
+            bits[:, :self.bits.shape[1]] = self.bits
+        else:
+            # New labels shift the codes of the ones sorting after them
+            remap = np.array([code_of[label] for label in self.labels], dtype=np.int32)
+            codes[:self.size] = remap[self.codes]
+            bits[remap, :self.bits.shape[1]] = self.bits
+
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+        new_codes = np.array([code_of[value] for value in values], dtype=np.int32)
+        existing = row_ids < self.size
+        old_codes = codes[row_ids[existing]]
+        byte, mask = bit_positions(row_ids)
+        np.bitwise_and.at(bits, (old_codes, byte[existing]), ~mask[existing])
+        np.bitwise_or.at(bits, (new_codes, byte), mask)
+        codes[row_ids] = new_codes
+
+        emptied = [code for code in np.unique(old_codes) if not bits[code].any()]
+        if emptied:
+            keep = np.ones(len(labels), dtype=bool)
+            keep[emptied] = False
+            remap = np.cumsum(keep, dtype=np.int32) - 1
+            codes = remap[codes]
+            labels = [label for label, kept in zip(labels, keep) if kept]
+            bits = bits[keep]
+
+        index = FacetIndex.__new__(FacetIndex)
+        index._set_state(codes, labels, bits)
+        return index
+
+    def state(self):
+        return {'codes': self.codes, 'labels': np.array(self.labels, dtype=str), 'bits': self.bits}
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls.__new__(cls)
+        index._set_state(state['codes'], state['labels'].tolist(), state['bits'])
+        return index
+
+
+class KeywordFacet:
+    """
+    One bitmap per keyword, marking the rows whose text contains it.
+
+    Unlike FacetIndex a row can belong to several keywords or to none.
+    """
+
+    def __init__(self, texts, keywords):
+        """
+        texts: lowercased text per row
+        keywords: lowercase keywords to index
+        """
+        bits = np.zeros((len(keywords), (len(texts) + 7) // 8), dtype=np.uint8)
+        for position, keyword in enumerate(keywords):
+            bits[position] = np.packbits(
+                np.fromiter((keyword in text for text in texts), dtype=bool, count=len(texts))
+            )
+        self._set_state(len(texts), list(keywords), bits)
+
+    def _set_state(self, size, keywords, bits):
+        self.size = size
+        self.keywords = keywords
+        self.bits = bits
+        self.bitmaps = dict(zip(keywords, bitmap_rows(bits, size)))
+
+    def counts(self, matches=None):
+        """Count the rows of a bitmap (all rows by default) per keyword"""
+        if matches is None:
+            return {keyword: len(bitmap) for keyword, bitmap in self.bitmaps.items()}
+        return {keyword: len(matches & bitmap) for keyword, bitmap in self.bitmaps.items()}
+
+    def updated(self, row_ids, texts, size):
+        """
+        Return a copy with the given rows' lowercased texts replaced. size is
+        the number of rows afterwards; rows past the current size are new.
+        """
+        bits = resized(self.bits, size)
+        byte, mask = bit_positions(row_ids)
+        for position, keyword in enumerate(self.keywords):
+            contains = np.fromiter((keyword in text for text in texts), dtype=bool, count=len(texts))
+            np.bitwise_and.at(bits[position], byte, ~mask)
+            np.bitwise_or.at(bits[position], byte[contains], mask[contains])
+
+        facet = KeywordFacet.__new__(KeywordFacet)
+        facet._set_state(size, self.keywords, bits)
+        return facet
+
+    def state(self):
+        return {
+            'size': np.array(self.size),
+            'keywords': np.array(self.keywords, dtype=str),
+            'bits': self.bits,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        facet = cls.__new__(cls)
+        facet._set_state(int(state['size']), state['keywords'].tolist(), state['bits'])
+        return facet
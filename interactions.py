@@ -0,0 +1,312 @@
+"""
+Pairwise drug interaction database, compiled for checking medicine regimens
+
+Interactions are loaded from a CSV of (ingredient_a, ingredient_b, severity,
+message) rows into a hash table keyed on the unordered ingredient pair, plus
+the ingredients each ingredient interacts with. A regimen's ingredients are
+numbered and every medicine becomes a bitset of them, so shared ingredients
+between two medicines are an integer AND, and interactions are looked up
+only for the ingredient pairs the regimen actually holds.
+
+The database is replaced as a whole when its file changes, without a restart.
+"""
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import pandas as pd
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+INTERACTION_COLUMNS = ('ingredient_a', 'ingredient_b', 'severity', 'message')
+
+# Accepted severities, most severe first
+SEVERITIES = ('high', 'medium', 'low')
+
+NO_INTERACTIONS = {
+    'type': 'no_interactions',
+    'message': 'No known interactions detected',
+    'severity': 'none',
+    'recommendation': 'Always consult a healthcare professional before taking multiple medications'
+}
+
+
+def set_bits(bitset):
+    """Yield the positions of the set bits of an integer, lowest first"""
+    while bitset:
+        lowest = bitset & -bitset
+        yield lowest.bit_length() - 1
+        bitset ^= lowest
+
+
+def pair_key(first, second):
+    """Return the key of an unordered ingredient pair"""
+    return (first, second) if first <= second else (second, first)
+
+
+def read_interactions(source):
+    """
+    Read and validate an interaction CSV from a path or file object. Returns
+    a list of (ingredient_a, ingredient_b, severity, message) tuples with
+    lowercased ingredients. Raises ValueError for a malformed file.
+    """
+    try:
+        table = pd.read_csv(source, dtype=str, keep_default_na=False)
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as e:
+        raise ValueError(f'Invalid interaction CSV: {e}') from e
+
+    missing = [column for column in INTERACTION_COLUMNS if column not in table.columns]
+    if missing:
+        raise ValueError(f"Interaction CSV is missing columns: {', '.join(missing)}")
+
+    interactions = []
+    columns = [table[column].str.strip().tolist() for column in INTERACTION_COLUMNS]
+    for line, (first, second, severity, message) in enumerate(zip(*columns), start=2):
+        first, second, severity = first.lower(), second.lower(), severity.lower()
+        if not first or not second or not message:
+            raise ValueError(f'Line {line}: ingredient_a, ingredient_b and message are required')
+        if first == second:
+            raise ValueError(f"Line {line}: '{first}' cannot interact with itself")
+        if severity not in SEVERITIES:
+            raise ValueError(f"Line {line}: unknown severity '{severity}'")
+        interactions.append((first, second, severity, message))
+    return interactions
+
+
+class InteractionDatabase:
+    """Pairwise interactions keyed on the unordered ingredient pair"""
+
+    def __init__(self, interactions):
+        """
+        interactions: iterable of (ingredient_a, ingredient_b, severity,
+        message); a pair listed twice keeps its last entry
+        """
+        self.pairs = {}
+        self.partners = defaultdict(set)
+        for first, second, severity, message in interactions:
+            self.pairs[pair_key(first, second)] = (severity, message)
+            self.partners[first].add(second)
+            self.partners[second].add(first)
+        self.partners = {ingredient: frozenset(others) for ingredient, others in self.partners.items()}
+        # Ingredient name -> database ingredients it stands for, filled in as seen
+        self._matches = {}
+
+    @classmethod
+    def from_csv(cls, path):
+        """Load the database from an interaction CSV; a missing file gives an empty one"""
+        if not os.path.exists(path):
+            logger.warning('No interaction database at %s', path)
+            return cls(())
+        return cls(read_interactions(path))
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def lookup(self, first, second):
+        """Return (severity, message) for a pair of ingredients in any order, or None"""
+        return self.pairs.get(pair_key(first, second))
+
+    def matching_ingredients(self, ingredient):
+        """
+        Return the database ingredients an ingredient name stands for: the
+        name itself or any word of it, such as 'aspirin' for 'aspirin gastro'
+        """
+        matches = self._matches.get(ingredient)
+        if matches is None:
+            matches = tuple(sorted({
+                word for word in (ingredient, *ingredient.split()) if word in self.partners
+            }))
+            self._matches[ingredient] = matches
+        return matches
+
+    def check(self, medicines):
+        """
+        Return the interactions within a regimen: per pair of medicines, one
+        finding for their shared ingredients and one per interacting
+        ingredient pair, most severe first. Returns NO_INTERACTIONS alone if
+        there are none.
+
+        medicines: sequence of (name, ingredient names) pairs
+        """
+        # Number the regimen's ingredients; every medicine becomes a bitset of
+        # ingredients and every ingredient a bitset of the medicines holding
+        # it, both for the regimen's own ingredients and the database's
+        bits = {}
+        masks = []
+        holders = []
+        database_holders = defaultdict(int)
+        for position, (_, ingredients) in enumerate(medicines):
+            mask = 0
+            for ingredient in ingredients:
+                bit = bits.setdefault(ingredient, len(bits))
+                if bit == len(holders):
+                    holders.append(0)
+                mask |= 1 << bit
+                holders[bit] |= 1 << position
+                for match in self.matching_ingredients(ingredient):
+                    database_holders[match] |= 1 << position
+            masks.append(mask)
+        ingredients = list(bits)
+
+        # (severity rank, finding) per pair of medicine positions
+        findings = defaultdict(list)
+
+        # Only ingredients held by two medicines or more make duplicates
+        duplicates = set()
+        for medicine_bits in holders:
+            if medicine_bits & (medicine_bits - 1):
+                positions = list(set_bits(medicine_bits))
+                for k, i in enumerate(positions):
+                    duplicates.update((i, j) for j in positions[k + 1:])
+        for i, j in duplicates:
+            findings[(i, j)].append((-1, {
+                'medicine1': medicines[i][0],
+                'medicine2': medicines[j][0],
+                'type': 'duplicate_ingredient',
+                'ingredients': [ingredients[bit] for bit in set_bits(masks[i] & masks[j])],
+                'warning': 'These medicines contain common active ingredients',
+                'severity': 'high',
+                'recommendation': 'Consult a healthcare professional before taking together'
+            }))
+
+        # Interacting ingredient pairs the regimen holds, each looked up once
+        for first, first_holders in database_holders.items():
+            partners = self.partners[first]
+            # Walk whichever is smaller, the ingredient's partners or the regimen's ingredients
+            if len(partners) > len(database_holders):
+                partners = [second for second in database_holders if second in partners]
+            for second in partners:
+                if second <= first or second not in database_holders:
+                    continue
+                severity, message = self.pairs[(first, second)]
+                # The ingredient held by medicine1 is named first
+                pairs = {}
+                for i in set_bits(first_holders):
+                    for j in set_bits(database_holders[second]):
+                        if i != j:
+                            pairs.setdefault(
+                                (min(i, j), max(i, j)), [first, second] if i < j else [second, first]
+                            )
+                for (i, j), interacting in pairs.items():
+                    findings[(i, j)].append((SEVERITIES.index(severity), {
+                        'medicine1': medicines[i][0],
+                        'medicine2': medicines[j][0],
+                        'type': 'known_interaction',
+                        'interacting_ingredients': interacting,
+                        'warning': message,
+                        'severity': severity,
+                        'recommendation': 'Consult a healthcare professional'
+                    }))
+
+        interactions = []
+        for pair in sorted(findings):
+            ranked = sorted(findings[pair], key=lambda item: (item[0], item[1].get('interacting_ingredients')))
+            interactions.extend(finding for _, finding in ranked)
+        return interactions or [dict(NO_INTERACTIONS)]
+
+
+def interactions_signature(path=None):
+    """Return the size and modification time of the interaction file, or None"""
+    path = path or Config.INTERACTIONS_PATH
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class InteractionReloader:
+    """
+    Holds the live interaction database and replaces it when its file
+    changes. A new database is fully loaded before the reference is swapped,
+    and a file that fails to load leaves the current one in place.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.database = None
+        self.signature = None
+        self.loaded_at = None
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    def get(self):
+        """Return the live database, loading it on first use"""
+        if self.database is None:
+            with self._lock:
+                if self.database is None:
+                    self._load()
+        return self.database
+
+    def _load(self):
+        path = self.path or Config.INTERACTIONS_PATH
+        # Taken before loading, so changes made during the load trigger another reload
+        signature = interactions_signature(path)
+        database = InteractionDatabase.from_csv(path)
+        self.database = database
+        self.signature = signature
+        self.loaded_at = datetime.utcnow()
+        self.last_error = None
+        logger.info('Interaction database loaded: %d pairs', len(database))
+        return database
+
+    def reload(self):
+        """
+        Load the interaction file again and swap it in; returns the new
+        database. Raises ValueError for a malformed file, keeping the
+        current database.
+        """
+        with self._lock:
+            try:
+                return self._load()
+            except ValueError as e:
+                self.last_error = str(e)
+                raise
+
+    def watch(self, interval):
+        """Poll the interaction file every interval seconds, reloading it when it changes"""
+        if self._watcher is not None:
+            return
+
+        def poll():
+            # A failed reload is retried only once the file changes again
+            attempted = None
+            while True:
+                time.sleep(interval)
+                try:
+                    signature = interactions_signature(self.path)
+                except OSError:
+                    continue
+                if signature in (self.signature, attempted):
+                    continue
+                attempted = signature
+                try:
+                    self.reload()
+                except (OSError, ValueError):
+                    logger.exception('Reloading the interaction database failed')
+
+        self._watcher = threading.Thread(target=poll, name='interactions-watch', daemon=True)
+        self._watcher.start()
+
+    def status(self):
+        """Return the size of the live database and the state of reloads"""
+        database = self.database
+        return {
+            'pairs': len(database) if database is not None else 0,
+            'ingredients': len(database.partners) if database is not None else 0,
+            'loaded_at': self.loaded_at.isoformat() if self.loaded_at else None,
+            'last_error': self.last_error,
+        }
+
+
+interaction_reloader = InteractionReloader()
+
+
+def get_interactions():
+    """Return the live interaction database"""
+    return interaction_reloader.get()
@@ -67,7 +67,7 @@ class Comparison(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    medicine_indices = db.Column(db.Text, nullable=False)  # Comma-separated indices
+    medicine_indices = db.Column(db.Text, nullable=False)  # Comma-separated medicine ids (or legacy indices)
     title = db.Column(db.String(255))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
@@ -0,0 +1,907 @@
+"""
+In-memory search indexes for the medicine catalog
+
+Every index keeps its data in flat NumPy arrays and can export them with
+state() and be rebuilt from them with from_state(), so a built index can be
+written to a catalog snapshot and memory-mapped back without rebuilding.
+
+Indexes are never modified in place. updated() returns a copy reflecting
+changed or added rows; the copy shares the packed arrays with the original
+and keeps its changes in small overlays, so catalog deltas cost time in
+proportion to their size and readers of the original are unaffected.
+"""
+import copy
+import re
+import heapq
+from bisect import bisect_left
+import itertools
+import math
+from collections import Counter, defaultdict
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+# Columns searched by the free-text query, in the order they are checked
+SEARCH_COLUMNS = ('name', 'composition', 'uses')
+
+EMPTY_POSTINGS = np.empty(0, dtype=np.int32)
+
+
+def tokenize(text):
+    """Split lowercased text into alphanumeric tokens"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def trigrams(text):
+    """Return the set of character trigrams of a string"""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def count_terms(fields):
+    """Count the tokens of a row's lowercased field values"""
+    counts = Counter()
+    for value in fields:
+        counts.update(TOKEN_PATTERN.findall(value))
+    return counts
+
+
+def intersect_postings(postings_lists):
+    """Intersect sorted row-id arrays, starting from the shortest one"""
+    if not postings_lists:
+        return EMPTY_POSTINGS
+
+    ordered = sorted(postings_lists, key=len)
+    result = ordered[0]
+    for postings in ordered[1:]:
+        if len(result) == 0:
+            break
+        # Binary-search the (shorter) result in each longer list
+        positions = np.searchsorted(postings, result)
+        positions[positions == len(postings)] = 0
+        result = result[postings[positions] == result]
+    return result
+
+
+def pack_strings(strings):
+    """Pack strings into one NUL-separated UTF-8 buffer"""
+    data = ''.join(string + '\0' for string in strings).encode('utf-8')
+    return {'data': np.frombuffer(data, dtype=np.uint8)}
+
+
+def unpack_strings(state):
+    """Decode a buffer written by pack_strings back into a list of strings"""
+    return bytes(state['data']).decode('utf-8').split('\0')[:-1]
+
+
+class KeyTable:
+    """
+    Sorted UTF-8 keys in a fixed-width bytes array.
+
+    Keys are found by binary search rather than through a dict, so a table
+    works unchanged on a read-only memory-mapped array.
+    """
+
+    def __init__(self, keys):
+        """
+        keys: sorted NumPy bytes array
+        """
+        self.keys = keys
+
+    @classmethod
+    def from_strings(cls, strings):
+        """Build a table of the distinct strings"""
+        return cls(np.array(sorted({string.encode('utf-8') for string in strings}), dtype=bytes))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, position):
+        return self.keys[position].decode('utf-8')
+
+    def __iter__(self):
+        return (key.decode('utf-8') for key in self.keys)
+
+    def find(self, key):
+        """Return the position of key, or -1 if it is not in the table"""
+        encoded = key.encode('utf-8')
+        position = int(np.searchsorted(self.keys, encoded))
+        if position < len(self.keys) and self.keys[position] == encoded:
+            return position
+        return -1
+
+    def prefix_range(self, prefix):
+        """Return the (start, stop) positions of the keys starting with prefix"""
+        encoded = prefix.encode('utf-8')
+        # 0xff never occurs in UTF-8, so it sorts after every key with this prefix
+        return (int(np.searchsorted(self.keys, encoded)),
+                int(np.searchsorted(self.keys, encoded + b'\xff')))
+
+    def complete(self, prefix, limit=10):
+        """Return up to limit keys starting with prefix, in sorted order"""
+        start, stop = self.prefix_range(prefix)
+        return [key.decode('utf-8') for key in self.keys[start:min(stop, start + limit)]]
+
+
+class PackedPostings:
+    """
+    Key -> postings mapping packed into flat arrays: a KeyTable, offsets into
+    one concatenated array of sorted ids and, optionally, a parallel array of
+    per-id values such as term frequencies.
+
+    Keys changed by updated() live in an overlay dict that takes precedence
+    over the packed arrays until the postings are compacted.
+    """
+
+    def __init__(self, keys, offsets, ids, values=None, overlay=None):
+        self.keys = keys
+        self.offsets = offsets
+        self.ids = ids
+        self.values = values
+        # key -> (ids, values) replacing or adding to the packed entries
+        self.overlay = overlay or {}
+
+    @classmethod
+    def from_lists(cls, postings, values=None, value_dtype=np.float32):
+        """
+        postings: mapping of key -> sorted list of ids
+        values: optional mapping of key -> list of values parallel to its ids
+        """
+        keys = sorted(postings)
+        lengths = np.fromiter((len(postings[key]) for key in keys), dtype=np.int64, count=len(keys))
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        def flatten(mapping, dtype):
+            return np.fromiter(
+                itertools.chain.from_iterable(mapping[key] for key in keys),
+                dtype=dtype, count=int(offsets[-1])
+            )
+
+        return cls(
+            KeyTable(np.array([key.encode('utf-8') for key in keys], dtype=bytes)),
+            offsets,
+            flatten(postings, np.int32),
+            None if values is None else flatten(values, value_dtype)
+        )
+
+    def _entry(self, key):
+        """Return (ids, values) for key, or None; values is None without values"""
+        entry = self.overlay.get(key)
+        if entry is not None:
+            return entry if len(entry[0]) else None
+
+        position = self.keys.find(key)
+        if position < 0:
+            return None
+        span = slice(self.offsets[position], self.offsets[position + 1])
+        return self.ids[span], None if self.values is None else self.values[span]
+
+    def __contains__(self, key):
+        return self._entry(key) is not None
+
+    def get(self, key):
+        """Return the ids stored under key, or None"""
+        entry = self._entry(key)
+        return None if entry is None else entry[0]
+
+    def get_values(self, key):
+        """Return the (ids, values) stored under key, or None"""
+        return self._entry(key)
+
+    def entries(self):
+        """Yield (key, ids, values) for every non-empty key"""
+        for position, key in enumerate(self.keys):
+            if key in self.overlay:
+                continue
+            span = slice(self.offsets[position], self.offsets[position + 1])
+            yield key, self.ids[span], None if self.values is None else self.values[span]
+        for key, (ids, values) in self.overlay.items():
+            if len(ids):
+                yield key, ids, values
+
+    def items(self):
+        """Yield (key, ids) pairs"""
+        for key, ids, _ in self.entries():
+            yield key, ids
+
+    def updated(self, removals, additions, values=None):
+        """
+        Return a copy with ids removed from and added to some keys.
+
+        removals: mapping of key -> ids to remove
+        additions: mapping of key -> ids to add
+        values: mapping of key -> values parallel to additions, required when
+        the postings carry values
+        """
+        overlay = dict(self.overlay)
+        for key in set(removals) | set(additions):
+            entry = self._entry(key)
+            if entry is None:
+                ids = EMPTY_POSTINGS
+                key_values = None if self.values is None else np.empty(0, dtype=self.values.dtype)
+            else:
+                ids, key_values = entry
+
+            if key in removals:
+                keep = ~np.isin(ids, np.asarray(removals[key], dtype=np.int32))
+                ids = ids[keep]
+                if key_values is not None:
+                    key_values = key_values[keep]
+
+            if key in additions:
+                ids = np.concatenate([ids, np.asarray(additions[key], dtype=np.int32)])
+                order = np.argsort(ids, kind='stable')
+                ids = ids[order]
+                if key_values is not None:
+                    key_values = np.concatenate(
+                        [key_values, np.asarray(values[key], dtype=key_values.dtype)]
+                    )[order]
+
+            overlay[key] = (ids, key_values)
+
+        return PackedPostings(self.keys, self.offsets, self.ids, self.values, overlay)
+
+    def compacted(self):
+        """Return the postings with the overlay merged into the packed arrays"""
+        if not self.overlay:
+            return self
+
+        postings = {}
+        values = None if self.values is None else {}
+        for key, ids, key_values in self.entries():
+            postings[key] = ids
+            if values is not None:
+                values[key] = key_values
+        return PackedPostings.from_lists(
+            postings, values, None if self.values is None else self.values.dtype
+        )
+
+    def state(self):
+        packed = self.compacted()
+        state = {'keys': packed.keys.keys, 'offsets': packed.offsets, 'ids': packed.ids}
+        if packed.values is not None:
+            state['values'] = packed.values
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(KeyTable(state['keys']), state['offsets'], state['ids'], state.get('values'))
+
+
+class PostingsIndex:
+    """Base class for key -> sorted row-id postings built from text fields"""
+
+    def __contains__(self, key):
+        return key in self.postings
+
+    def lookup(self, key):
+        """Return the sorted row ids containing a key"""
+        postings = self.postings.get(key)
+        return EMPTY_POSTINGS if postings is None else postings
+
+
+class InvertedIndex(PostingsIndex):
+    """
+    Token-level inverted index: term -> sorted array of row ids, with the
+    term's frequency in each of those rows and the token length of every row.
+    """
+
+    def __init__(self, documents):
+        """
+        documents: sequence of per-row tuples of lowercased field values
+        """
+        self.num_rows = len(documents)
+        self.lengths = np.zeros(self.num_rows, dtype=np.float32)
+
+        postings = defaultdict(list)
+        frequencies = defaultdict(list)
+        for row_id, fields in enumerate(documents):
+            counts = count_terms(fields)
+            self.lengths[row_id] = sum(counts.values())
+            for term, count in counts.items():
+                postings[term].append(row_id)
+                frequencies[term].append(count)
+
+        # Row ids are appended in increasing order, so every list is already sorted
+        self.postings = PackedPostings.from_lists(postings, frequencies)
+
+    def term_frequencies(self, term, row_ids):
+        """Return the frequency of term in each of the sorted row_ids"""
+        entry = self.postings.get_values(term)
+        if entry is None:
+            return np.zeros(len(row_ids), dtype=np.float32)
+
+        postings, frequencies = entry
+        positions = np.searchsorted(postings, row_ids)
+        positions[positions == len(postings)] = 0
+        found = postings[positions] == row_ids
+        return np.where(found, frequencies[positions], 0).astype(np.float32)
+
+    def updated(self, changes, num_rows):
+        """
+        Return a copy reflecting changed and added rows.
+
+        changes: mapping of row id -> (old fields, or None for a new row, new fields)
+        num_rows: number of rows after the change
+        """
+        lengths = np.zeros(num_rows, dtype=np.float32)
+        lengths[:self.num_rows] = self.lengths
+
+        # Only terms whose count in a row changed touch the postings
+        removals = defaultdict(list)
+        additions = defaultdict(list)
+        frequencies = defaultdict(list)
+        for row_id, (old_fields, new_fields) in changes.items():
+            old_counts = count_terms(old_fields or ())
+            new_counts = count_terms(new_fields)
+            lengths[row_id] = sum(new_counts.values())
+            for term, count in old_counts.items():
+                if new_counts.get(term) != count:
+                    removals[term].append(row_id)
+            for term, count in new_counts.items():
+                if old_counts.get(term) != count:
+                    additions[term].append(row_id)
+                    frequencies[term].append(count)
+
+        index = copy.copy(self)
+        index.num_rows = num_rows
+        index.lengths = lengths
+        index.postings = self.postings.updated(removals, additions, frequencies)
+        return index
+
+    def state(self):
+        return {'lengths': self.lengths, 'postings': self.postings.state()}
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls.__new__(cls)
+        index.num_rows = len(state['lengths'])
+        index.lengths = state['lengths']
+        index.postings = PackedPostings.from_state(state['postings'])
+        return index
+
+
+class TrigramIndex(PostingsIndex):
+    """
+    Character-trigram index: trigram -> sorted array of row ids.
+
+    Every row containing a query of three or more characters also contains
+    all of the query's trigrams, so intersecting their postings yields a
+    candidate superset. Candidates are then verified with a plain substring
+    check, which keeps results identical to a full scan while the cost follows
+    the number of matches rather than the catalog size.
+    """
+
+    def __init__(self, columns):
+        """
+        columns: sequence of per-field lists of lowercased values, one per row
+        """
+        self.columns = tuple(columns)
+        self.num_rows = len(self.columns[0]) if self.columns else 0
+
+        postings = defaultdict(list)
+        for row_id, fields in enumerate(zip(*self.columns)):
+            row_grams = set()
+            for value in fields:
+                row_grams.update(trigrams(value))
+            for gram in row_grams:
+                postings[gram].append(row_id)
+
+        self.postings = PackedPostings.from_lists(postings)
+
+    def candidates(self, query):
+        """
+        Return candidate row ids for a lowercased query, or None if the query
+        is too short to have trigrams.
+        """
+        grams = trigrams(query)
+        if not grams:
+            return None
+
+        postings_lists = []
+        for gram in grams:
+            postings = self.postings.get(gram)
+            if postings is None:
+                return EMPTY_POSTINGS
+            postings_lists.append(postings)
+        return intersect_postings(postings_lists)
+
+    def match(self, query):
+        """Return sorted row ids whose name, composition or uses contain the query"""
+        query = query.lower()
+        candidates = self.candidates(query)
+        if candidates is None:
+            # One- and two-character queries have no trigrams; scan instead
+            candidates = range(self.num_rows)
+        else:
+            candidates = candidates.tolist()
+
+        return np.asarray(
+            [row_id for row_id in candidates
+             if any(query in column[row_id] for column in self.columns)],
+            dtype=np.int32
+        )
+
+    def updated(self, columns, row_ids):
+        """
+        Return a copy over the new columns, reflecting the given changed and
+        added rows. Rows past the end of the current columns are new.
+        """
+        columns = tuple(columns)
+        removals = defaultdict(list)
+        additions = defaultdict(list)
+        for row_id in row_ids:
+            old_grams = set()
+            if row_id < self.num_rows:
+                for column in self.columns:
+                    old_grams.update(trigrams(column[row_id]))
+            new_grams = set()
+            for column in columns:
+                new_grams.update(trigrams(column[row_id]))
+
+            for gram in old_grams - new_grams:
+                removals[gram].append(row_id)
+            for gram in new_grams - old_grams:
+                additions[gram].append(row_id)
+
+        index = copy.copy(self)
+        index.columns = columns
+        index.num_rows = len(columns[0]) if columns else 0
+        index.postings = self.postings.updated(removals, additions)
+        return index
+
+    def state(self):
+        return {'postings': self.postings.state()}
+
+    @classmethod
+    def from_state(cls, state, columns):
+        """Rebuild the index from state and the lowercased columns it covers"""
+        index = cls.__new__(cls)
+        index.columns = tuple(columns)
+        index.num_rows = len(index.columns[0]) if index.columns else 0
+        index.postings = PackedPostings.from_state(state['postings'])
+        return index
+
+
+class PrefixIndex:
+    """
+    Sorted array of distinct values for prefix lookups.
+
+    A prefix selects a contiguous range of the sorted lowercased keys, so a
+    completion costs one binary search plus the number of suggestions returned.
+    Values added and removed by updated() are kept in small overlays that are
+    merged into completions.
+    """
+
+    def __init__(self, values):
+        pairs = sorted({(str(value).lower(), str(value)) for value in values})
+        self.keys = KeyTable(np.array([key.encode('utf-8') for key, _ in pairs], dtype=bytes))
+        self.values = [value for _, value in pairs]
+        self.extra = []
+        self.removed = frozenset()
+
+    def _packed_contains(self, value):
+        encoded = value.lower().encode('utf-8')
+        start = int(np.searchsorted(self.keys.keys, encoded, side='left'))
+        stop = int(np.searchsorted(self.keys.keys, encoded, side='right'))
+        return value in self.values[start:stop]
+
+    def complete(self, prefix, limit=10):
+        """Return up to limit values starting with prefix, in alphabetical order"""
+        prefix = prefix.lower()
+        start, stop = self.keys.prefix_range(prefix)
+        if not self.extra and not self.removed:
+            return self.values[start:min(stop, start + limit)]
+
+        stop = min(stop, start + limit + len(self.removed))
+        packed = (
+            (self.keys[position], self.values[position])
+            for position in range(start, stop)
+            if self.values[position] not in self.removed
+        )
+        extra = itertools.takewhile(
+            lambda pair: pair[0].startswith(prefix),
+            itertools.islice(self.extra, bisect_left(self.extra, (prefix,)), None)
+        )
+        return [value for _, value in itertools.islice(heapq.merge(packed, extra), limit)]
+
+    def updated(self, added, removed=()):
+        """Return a copy that also completes to the added values and not to the removed ones"""
+        added = {str(value) for value in added}
+        removed = {str(value) for value in removed} - added
+
+        index = copy.copy(self)
+        index.removed = (self.removed - added) | {
+            value for value in removed if self._packed_contains(value)
+        }
+        index.extra = sorted(
+            {pair for pair in self.extra if pair[1] not in removed}
+            | {(value.lower(), value) for value in added if not self._packed_contains(value)}
+        )
+        return index
+
+    def state(self):
+        if self.extra or self.removed:
+            values = [value for value in self.values if value not in self.removed]
+            return PrefixIndex(values + [value for _, value in self.extra]).state()
+        return {'keys': self.keys.keys, 'values': pack_strings(self.values)}
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls.__new__(cls)
+        index.keys = KeyTable(state['keys'])
+        index.values = unpack_strings(state['values'])
+        index.extra = []
+        index.removed = frozenset()
+        return index
+
+
+def edit_distance(a, b, max_distance):
+    """
+    Optimal string alignment distance between a and b, or max_distance + 1
+    once it is known to exceed max_distance.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+
+    return previous[-1]
+
+
+def deletes(word, max_distance):
+    """Return every string obtained by deleting up to max_distance characters"""
+    results = {word}
+    frontier = {word}
+    for _ in range(max_distance):
+        frontier = {
+            candidate[:i] + candidate[i + 1:]
+            for candidate in frontier
+            for i in range(len(candidate))
+        }
+        results |= frontier
+    return results
+
+
+class SpellingIndex:
+    """
+    Symmetric-delete spelling index (SymSpell) over a term vocabulary.
+
+    Every vocabulary term is stored under all strings reachable by deleting up
+    to max_distance characters from its first prefix_length characters. A
+    lookup generates the same deletes for the input word, so candidates within
+    the edit distance are found with a bounded number of dictionary probes
+    regardless of vocabulary size; only those candidates are then verified.
+    """
+
+    def __init__(self, vocabulary, max_distance=2, prefix_length=7):
+        """
+        vocabulary: mapping of term -> frequency, used to break ties
+        """
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+
+        self.terms = KeyTable.from_strings(vocabulary)
+        self.frequencies = np.array([vocabulary[term] for term in self.terms], dtype=np.int64)
+
+        # delete -> positions of the terms it was generated from
+        term_deletes = defaultdict(list)
+        for position, term in enumerate(self.terms):
+            for delete in deletes(term[:prefix_length], max_distance):
+                term_deletes[delete].append(position)
+        self.deletes = PackedPostings.from_lists(term_deletes)
+
+        # Terms added by updated(), with their deletes, and terms it removed
+        self.extra_terms = {}
+        self.extra_deletes = {}
+        self.removed = frozenset()
+
+    def __contains__(self, term):
+        if term in self.removed:
+            return False
+        return term in self.extra_terms or self.terms.find(term) >= 0
+
+    def lookup(self, word, max_distance=None):
+        """
+        Return vocabulary terms within max_distance of word, closest and most
+        frequent first, as (term, distance) pairs.
+        """
+        if max_distance is None:
+            max_distance = self.max_distance
+        if word in self:
+            return [(word, 0)]
+
+        # (term, frequency) pairs sharing a delete with the word
+        candidates = set()
+        for delete in deletes(word[:self.prefix_length], max_distance):
+            positions = self.deletes.get(delete)
+            if positions is not None:
+                candidates.update(
+                    (self.terms[position], int(self.frequencies[position]))
+                    for position in positions.tolist()
+                )
+            candidates.update(
+                (term, self.extra_terms[term]) for term in self.extra_deletes.get(delete, ())
+            )
+
+        matches = []
+        for term, frequency in candidates:
+            if term in self.removed:
+                continue
+            distance = edit_distance(word, term, max_distance)
+            if distance <= max_distance:
+                matches.append((distance, -frequency, term))
+
+        matches.sort()
+        return [(term, distance) for distance, _, term in matches]
+
+    def correct(self, text):
+        """
+        Replace unknown words in lowercased text with their closest vocabulary
+        term. Returns the corrected text, or None if nothing changed.
+        """
+        corrected = text
+        for token in reversed(list(TOKEN_PATTERN.finditer(text))):
+            word = token.group()
+            if not word.isalpha() or word in self:
+                continue
+            matches = self.lookup(word)
+            if matches:
+                corrected = corrected[:token.start()] + matches[0][0] + corrected[token.end():]
+
+        return corrected if corrected != text else None
+
+    def updated(self, vocabulary, removed=()):
+        """
+        Return a copy that knows the new terms of vocabulary (a mapping of
+        term -> frequency) and no longer knows the removed terms. The
+        frequencies of known terms, which only break ties, are not changed
+        until a rebuild.
+        """
+        index = copy.copy(self)
+        index.extra_terms = dict(self.extra_terms)
+        index.extra_deletes = dict(self.extra_deletes)
+        index.removed = (self.removed - set(vocabulary)) | set(removed)
+        for term, frequency in vocabulary.items():
+            if term in index:
+                continue
+            index.extra_terms[term] = frequency
+            for delete in deletes(term[:self.prefix_length], self.max_distance):
+                index.extra_deletes[delete] = index.extra_deletes.get(delete, ()) + (term,)
+        return index
+
+    def state(self):
+        if self.extra_terms or self.removed:
+            vocabulary = dict(zip(self.terms, self.frequencies.tolist()))
+            vocabulary.update(self.extra_terms)
+            for term in self.removed:
+                vocabulary.pop(term, None)
+            return SpellingIndex(vocabulary, self.max_distance, self.prefix_length).state()
+        return {
+            'parameters': np.array([self.max_distance, self.prefix_length]),
+            'terms': self.terms.keys,
+            'frequencies': self.frequencies,
+            'deletes': self.deletes.state(),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls.__new__(cls)
+        index.max_distance, index.prefix_length = (int(value) for value in state['parameters'])
+        index.terms = KeyTable(state['terms'])
+        index.frequencies = state['frequencies']
+        index.deletes = PackedPostings.from_state(state['deletes'])
+        index.extra_terms = {}
+        index.extra_deletes = {}
+        index.removed = frozenset()
+        return index
+
+
+class BM25Index:
+    """
+    BM25F relevance ranking over weighted text fields.
+
+    Each field keeps its own inverted index with term frequencies and row
+    lengths; inverse document frequencies are derived from document counts
+    kept over all fields. Query words that are not whole terms are expanded to
+    the vocabulary terms they prefix, so partially typed words still
+    contribute to the score.
+    """
+
+    def __init__(self, fields, weights, k1=1.2, b=0.75, max_expansions=20):
+        """
+        fields: mapping of field name -> list of lowercased values per row
+        weights: mapping of field name -> score weight
+        """
+        self.weights = weights
+        self.k1 = k1
+        self.b = b
+        self.max_expansions = max_expansions
+
+        self.field_indexes = {
+            field: InvertedIndex([(value,) for value in values])
+            for field, values in fields.items()
+        }
+        self.num_rows = len(next(iter(fields.values()), ()))
+        self._set_average_lengths()
+
+        document_frequency = Counter()
+        for field, index in self.field_indexes.items():
+            for term, postings in index.postings.items():
+                document_frequency[term] += len(postings)
+
+        # Vocabulary of every indexed term, with its document count at the same position
+        self.terms = KeyTable.from_strings(document_frequency)
+        self.document_frequencies = np.array(
+            [document_frequency[term] for term in self.terms], dtype=np.int64
+        )
+        # Document counts changed by updated(), including new terms
+        self.frequency_overlay = {}
+
+    def _set_average_lengths(self):
+        self.average_lengths = {
+            field: max(float(index.lengths.mean()), 1.0) if self.num_rows else 1.0
+            for field, index in self.field_indexes.items()
+        }
+
+    def document_frequency(self, term):
+        """Return the number of (row, field) pairs containing term"""
+        if term in self.frequency_overlay:
+            return self.frequency_overlay[term]
+        position = self.terms.find(term)
+        return int(self.document_frequencies[position]) if position >= 0 else 0
+
+    def idf(self, term):
+        """Return the inverse document frequency of term"""
+        count = self.document_frequency(term)
+        return math.log(1 + (self.num_rows - count + 0.5) / (count + 0.5))
+
+    def _expand(self, prefix):
+        """Return up to max_expansions indexed terms starting with prefix"""
+        start, stop = self.terms.prefix_range(prefix)
+        packed = (self.terms[position] for position in range(start, stop))
+        added = sorted(
+            term for term in self.frequency_overlay
+            if term.startswith(prefix) and self.terms.find(term) < 0
+        )
+
+        terms = []
+        for term in heapq.merge(packed, added):
+            if len(terms) == self.max_expansions:
+                break
+            if self.document_frequency(term) > 0:
+                terms.append(term)
+        return terms
+
+    def query_terms(self, query):
+        """Return the scoring terms of a query, expanding partial words"""
+        terms = []
+        for word in dict.fromkeys(tokenize(query)):
+            if self.document_frequency(word) > 0:
+                terms.append(word)
+            else:
+                terms.extend(self._expand(word))
+        return terms
+
+    def scores(self, query, row_ids):
+        """Return the BM25F score of each of the sorted row_ids for query"""
+        scores = np.zeros(len(row_ids), dtype=np.float64)
+        if len(row_ids) == 0:
+            return scores
+
+        normalizers = {
+            field: 1 - self.b + self.b * index.lengths[row_ids] / self.average_lengths[field]
+            for field, index in self.field_indexes.items()
+        }
+
+        for term in self.query_terms(query):
+            weighted = np.zeros(len(row_ids), dtype=np.float64)
+            for field, index in self.field_indexes.items():
+                if term in index:
+                    weighted += (
+                        self.weights[field] * index.term_frequencies(term, row_ids)
+                        / normalizers[field]
+                    )
+            scores += self.idf(term) * weighted * (self.k1 + 1) / (weighted + self.k1)
+
+        return scores
+
+    def top_k(self, query, row_ids, k):
+        """
+        Return the k best-scoring of the sorted row_ids, best first.
+
+        Selection partitions the scores around the k-th best, so only k rows
+        are sorted; ties keep catalog order.
+        """
+        row_ids = np.asarray(row_ids)
+        scores = self.scores(query, row_ids)
+        if k <= 0:
+            return np.empty(0, dtype=np.int32)
+        if k < len(scores):
+            threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+            above = np.flatnonzero(scores > threshold)
+            # Of the rows tied with the k-th best, the earliest ones make up the k
+            tied = np.flatnonzero(scores == threshold)[:k - len(above)]
+            candidates = np.concatenate((above, tied))
+        else:
+            candidates = np.arange(len(scores))
+        best = candidates[np.lexsort((candidates, -scores[candidates]))]
+        return row_ids[best].astype(np.int32)
+
+    def updated(self, changes, num_rows):
+        """
+        Return a copy reflecting changed and added rows.
+
+        changes: mapping of field -> {row id: (old value, or None for a new
+        row, new value)}; new rows must appear under every field
+        num_rows: number of rows after the change
+        """
+        index = copy.copy(self)
+        index.num_rows = num_rows
+        index.frequency_overlay = dict(self.frequency_overlay)
+        index.field_indexes = {}
+        for field, field_index in self.field_indexes.items():
+            field_changes = changes.get(field, {})
+            index.field_indexes[field] = field_index.updated(
+                {
+                    row_id: (None if old is None else (old,), (new,))
+                    for row_id, (old, new) in field_changes.items()
+                },
+                num_rows
+            )
+            for old, new in field_changes.values():
+                old_terms = set(TOKEN_PATTERN.findall(old)) if old is not None else set()
+                new_terms = set(TOKEN_PATTERN.findall(new))
+                for term in old_terms - new_terms:
+                    index.frequency_overlay[term] = index.document_frequency(term) - 1
+                for term in new_terms - old_terms:
+                    index.frequency_overlay[term] = index.document_frequency(term) + 1
+
+        index._set_average_lengths()
+        return index
+
+    def state(self):
+        terms, document_frequencies = self.terms.keys, self.document_frequencies
+        if self.frequency_overlay:
+            merged = dict(zip(self.terms, self.document_frequencies.tolist()))
+            merged.update(self.frequency_overlay)
+            vocabulary = KeyTable.from_strings(term for term, count in merged.items() if count > 0)
+            terms = vocabulary.keys
+            document_frequencies = np.array([merged[term] for term in vocabulary], dtype=np.int64)
+
+        return {
+            'parameters': np.array([self.k1, self.b, self.max_expansions]),
+            'weights': np.array([self.weights[field] for field in self.field_indexes]),
+            'fields': {field: index.state() for field, index in self.field_indexes.items()},
+            'terms': terms,
+            'document_frequencies': document_frequencies,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls.__new__(cls)
+        k1, b, max_expansions = state['parameters']
+        index.k1, index.b, index.max_expansions = float(k1), float(b), int(max_expansions)
+        index.field_indexes = {
+            field: InvertedIndex.from_state(field_state)
+            for field, field_state in state['fields'].items()
+        }
+        index.weights = dict(zip(index.field_indexes, state['weights'].tolist()))
+        index.num_rows = len(next(iter(index.field_indexes.values())).lengths)
+        index._set_average_lengths()
+        index.terms = KeyTable(state['terms'])
+        index.document_frequencies = state['document_frequencies']
+        index.frequency_overlay = {}
+        return index
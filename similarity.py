@@ -0,0 +1,341 @@
+"""
+TF-IDF similarity between medicines, precomputed as a nearest-neighbour table
+
+Every row is a document made of a few text fields. The documents' term
+counts are kept as a sparse matrix twice: by row (CSR) and by term (the
+transpose, each term's rows in increasing order). Weighting it by TF-IDF and
+multiplying it by its own transpose, a block of rows at a time, gives each
+row's exact most similar rows. Those are stored in fixed-width tables, so
+looking them up is a slice and nothing is computed per request.
+
+A term's products grow with the square of its rows, so terms in more than a
+share of the rows are ignored like stop words. The share scales with the
+catalog, so common ingredients keep their weight, and small catalogs keep
+every term found in up to a minimum number of rows.
+"""
+import copy
+
+import numpy as np
+
+from search_index import count_terms, pack_strings, unpack_strings
+
+# Rows are multiplied in blocks making about this many partial products, which
+# bounds the memory a block needs
+BLOCK_PRODUCTS = 1 << 22
+
+
+def expand_spans(starts, lengths):
+    """Return the positions start, start + 1, ... of consecutive spans, concatenated"""
+    return np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+
+
+def inverse_document_frequencies(document_frequency, num_rows, max_share, min_rows):
+    """
+    Return the smoothed IDF of every term. Terms in more than max_share of
+    the rows, and in more than min_rows rows, get weight 0 like stop words.
+    """
+    idf = np.log((1 + num_rows) / (1 + document_frequency)) + 1
+    idf[document_frequency > max(max_share * num_rows, min_rows)] = 0
+    return idf
+
+
+def best_per_query(queries, others, scores, limit):
+    """
+    Keep the limit best-scoring pairs of every query, ties to the earlier
+    other row. Returns (queries, others, scores, ranks) sorted by query and
+    rank.
+    """
+    if not len(queries):
+        return queries, others, scores, queries
+    order = np.lexsort((others, -scores, queries))
+    queries, others, scores = queries[order], others[order], scores[order]
+    firsts = np.flatnonzero(np.r_[True, queries[1:] != queries[:-1]])
+    ranks = np.arange(len(queries)) - np.repeat(firsts, np.diff(np.r_[firsts, len(queries)]))
+    top = ranks < limit
+    return queries[top], others[top], scores[top], ranks[top]
+
+
+def pair_similarities(query_rows, matrix):
+    """
+    Yield (queries, others, sums) blocks holding the dot product of every
+    query row with every other row it shares a weighted term with.
+
+    matrix: dict of the TF-IDF matrix by row (offsets, terms, weights) and
+    by term (term_offsets, term_rows, term_weights)
+    """
+    offsets, terms, weights = matrix['offsets'], matrix['terms'], matrix['weights']
+    term_offsets, term_rows = matrix['term_offsets'], matrix['term_rows']
+    term_weights = matrix['term_weights']
+    num_rows = len(offsets) - 1
+
+    # The query rows' weighted entries, in row order
+    row_lengths = offsets[query_rows + 1] - offsets[query_rows]
+    entries = expand_spans(offsets[query_rows], row_lengths)
+    rows = np.repeat(query_rows, row_lengths)
+    weighted = weights[entries] > 0
+    entries, rows = entries[weighted], rows[weighted]
+    if not len(entries):
+        return
+
+    # An entry pairs with every entry of its term; blocks end on row boundaries
+    lengths = term_offsets[terms[entries] + 1] - term_offsets[terms[entries]]
+    products = np.cumsum(lengths)
+    row_starts = np.r_[np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]]), len(rows)]
+    start = 0
+    while start < len(entries):
+        done = products[start - 1] if start else 0
+        end = max(int(np.searchsorted(products, done + BLOCK_PRODUCTS, 'right')), start + 1)
+        end = int(row_starts[np.searchsorted(row_starts, end)])
+
+        block, block_lengths = entries[start:end], lengths[start:end]
+        paired = expand_spans(term_offsets[terms[block]], block_lengths)
+        queries = np.repeat(rows[start:end], block_lengths)
+        others = term_rows[paired]
+        partial = np.repeat(weights[block], block_lengths) * term_weights[paired]
+
+        # Sum the partial products of every (query, other) pair
+        distinct = queries != others
+        pairs, pair_of = np.unique(
+            queries[distinct].astype(np.int64) * num_rows + others[distinct], return_inverse=True
+        )
+        yield pairs // num_rows, pairs % num_rows, np.bincount(pair_of, weights=partial[distinct])
+        start = end
+
+
+def nearest_neighbours(query_rows, matrix, neighbours, scores):
+    """
+    Fill the rows query_rows of the neighbours and scores tables with each
+    row's k most similar other rows, best first and ties to the earlier row,
+    padded with -1.
+    """
+    neighbours[query_rows] = -1
+    scores[query_rows] = 0
+    k = neighbours.shape[1]
+    if not k:
+        return
+    for queries, others, sums in pair_similarities(query_rows, matrix):
+        queries, others, sums, ranks = best_per_query(queries, others, sums, k)
+        neighbours[queries, ranks] = others
+        scores[queries, ranks] = sums
+
+
+class SimilarityIndex:
+    """
+    Each row's k most similar rows by cosine similarity of TF-IDF vectors.
+
+    Keeps the term counts of every row both by row (offsets, terms, counts)
+    and by term (term_offsets, term_rows, term_counts) over a vocabulary, so
+    the table can be recomputed for the rows a change affects.
+    """
+
+    def __init__(self, documents, k=10, max_share=0.05, min_rows=100):
+        """
+        documents: sequence of per-row tuples of lowercased field values
+        k: neighbours kept per row
+        max_share, min_rows: terms in more than this share of the rows, and
+        in more than min_rows rows, are ignored
+        """
+        vocabulary = {}
+        offsets = np.zeros(len(documents) + 1, dtype=np.int64)
+        terms = []
+        counts = []
+        for row_id, fields in enumerate(documents):
+            for term_id, count in sorted(
+                (vocabulary.setdefault(term, len(vocabulary)), count)
+                for term, count in count_terms(fields).items()
+            ):
+                terms.append(term_id)
+                counts.append(count)
+            offsets[row_id + 1] = len(terms)
+
+        self.k = k
+        self.max_share = max_share
+        self.min_rows = min_rows
+        self.vocabulary = list(vocabulary)
+        self._term_ids = vocabulary
+        self.offsets = offsets
+        self.terms = np.array(terms, dtype=np.int32)
+        self.counts = np.array(counts, dtype=np.int32)
+
+        # The transpose: the same entries sorted by term, then row
+        rows = np.repeat(np.arange(len(documents), dtype=np.int32), np.diff(offsets))
+        by_term = np.argsort(self.terms, kind='stable')
+        self.term_offsets = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.terms, minlength=len(self.vocabulary)), out=self.term_offsets[1:])
+        self.term_rows = rows[by_term]
+        self.term_counts = self.counts[by_term]
+
+        self.neighbours = np.full((len(documents), k), -1, dtype=np.int32)
+        self.scores = np.zeros((len(documents), k), dtype=np.float16)
+        nearest_neighbours(np.arange(len(documents)), self._matrix(), self.neighbours, self.scores)
+
+    def _matrix(self):
+        """Return the TF-IDF weighted matrix for nearest_neighbours"""
+        num_rows = len(self.offsets) - 1
+        idf = inverse_document_frequencies(
+            np.diff(self.term_offsets), num_rows, self.max_share, self.min_rows
+        )
+
+        rows = np.repeat(np.arange(num_rows), np.diff(self.offsets))
+        weights = (1 + np.log(self.counts)) * idf[self.terms]
+        norms = np.sqrt(np.bincount(rows, weights=weights ** 2, minlength=num_rows))
+        norms[norms == 0] = 1
+        weights /= norms[rows]
+
+        term_idf = np.repeat(idf, np.diff(self.term_offsets))
+        return {
+            'offsets': self.offsets,
+            'terms': self.terms,
+            'weights': weights,
+            'term_offsets': self.term_offsets,
+            'term_rows': self.term_rows,
+            'term_weights': (1 + np.log(self.term_counts)) * term_idf / norms[self.term_rows],
+        }
+
+    def similar(self, row_id):
+        """Return (row_ids, scores) of the rows most similar to a row, best first"""
+        neighbours = self.neighbours[row_id]
+        found = neighbours >= 0
+        return neighbours[found], self.scores[row_id][found]
+
+    def updated(self, documents, num_rows):
+        """
+        Return a copy with the documents of some rows replaced.
+
+        The replaced rows and the rows that listed them get their neighbours
+        recomputed; every other row sharing a term with a replaced row takes
+        it into its list if it now ranks there. Scores between unchanged rows
+        keep the document frequencies of the time until the next full build.
+
+        documents: mapping of row id -> new tuple of lowercased field values
+        num_rows: number of rows after the change; rows past the current
+        size are new
+        """
+        vocabulary = list(self.vocabulary)
+        term_ids = self._term_ids
+        if term_ids is None:
+            term_ids = {term: term_id for term_id, term in enumerate(vocabulary)}
+        else:
+            term_ids = dict(term_ids)
+
+        size = len(self.offsets) - 1
+        replaced = np.zeros(num_rows, dtype=bool)
+        replaced[list(documents)] = True
+
+        new_rows, new_terms, new_counts = [], [], []
+        for row_id in sorted(documents):
+            counted = count_terms(documents[row_id])
+            for term in counted:
+                if term not in term_ids:
+                    term_ids[term] = len(vocabulary)
+                    vocabulary.append(term)
+            for term_id, count in sorted((term_ids[term], count) for term, count in counted.items()):
+                new_rows.append(row_id)
+                new_terms.append(term_id)
+                new_counts.append(count)
+        new_rows = np.array(new_rows, dtype=np.int32)
+        new_terms = np.array(new_terms, dtype=np.int32)
+        new_counts = np.array(new_counts, dtype=np.int32)
+
+        # By row: the replaced rows' entries are dropped and the new ones
+        # inserted where their rows start
+        rows = np.repeat(np.arange(size, dtype=np.int32), np.diff(self.offsets))
+        kept = ~replaced[rows]
+        kept_lengths = np.bincount(rows[kept], minlength=num_rows)
+        kept_starts = np.cumsum(kept_lengths) - kept_lengths
+        offsets = np.zeros(num_rows + 1, dtype=np.int64)
+        np.cumsum(kept_lengths + np.bincount(new_rows, minlength=num_rows), out=offsets[1:])
+
+        # By term: the new entries go in by binary search on (term, row)
+        term_of = np.repeat(np.arange(len(self.vocabulary), dtype=np.int64), np.diff(self.term_offsets))
+        term_kept = ~replaced[self.term_rows]
+        term_rows = self.term_rows[term_kept]
+        order = np.lexsort((new_rows, new_terms))
+        insert_at = np.searchsorted(
+            term_of[term_kept] * num_rows + term_rows,
+            new_terms[order].astype(np.int64) * num_rows + new_rows[order]
+        )
+        term_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(term_of[term_kept], minlength=len(vocabulary))
+            + np.bincount(new_terms, minlength=len(vocabulary)),
+            out=term_offsets[1:]
+        )
+
+        index = copy.copy(self)
+        index.vocabulary = vocabulary
+        index._term_ids = term_ids
+        index.offsets = offsets
+        index.terms = np.insert(self.terms[kept], kept_starts[new_rows], new_terms)
+        index.counts = np.insert(self.counts[kept], kept_starts[new_rows], new_counts)
+        index.term_offsets = term_offsets
+        index.term_rows = np.insert(term_rows, insert_at, new_rows[order])
+        index.term_counts = np.insert(self.term_counts[term_kept], insert_at, new_counts[order])
+
+        index.neighbours = np.full((num_rows, self.k), -1, dtype=np.int32)
+        index.neighbours[:size] = self.neighbours
+        index.scores = np.zeros((num_rows, self.k), dtype=np.float16)
+        index.scores[:size] = self.scores
+        if not self.k:
+            return index
+
+        # Rows that listed a replaced row may need any other row in its place
+        recomputed = replaced.copy()
+        recomputed[:size] |= (replaced[np.maximum(self.neighbours, 0)] & (self.neighbours >= 0)).any(axis=1)
+        matrix = index._matrix()
+        nearest_neighbours(np.flatnonzero(recomputed), matrix, index.neighbours, index.scores)
+
+        # The other rows sharing a term with a replaced row: their lists merged
+        # with the replaced rows' new scores
+        candidates = [
+            (others[keep], queries[keep], sums[keep])
+            for queries, others, sums in pair_similarities(np.flatnonzero(replaced), matrix)
+            for keep in [~recomputed[others]]
+        ]
+        if candidates:
+            rows, others, sums = (np.concatenate(parts) for parts in zip(*candidates))
+            merged = np.unique(rows)
+            listed = index.neighbours[merged] >= 0
+            rows, others, sums, ranks = best_per_query(
+                np.concatenate([np.repeat(merged, listed.sum(axis=1)), rows]),
+                np.concatenate([index.neighbours[merged][listed], others]),
+                np.concatenate([index.scores[merged][listed].astype(np.float64), sums]),
+                self.k
+            )
+            index.neighbours[merged] = -1
+            index.scores[merged] = 0
+            index.neighbours[rows, ranks] = others
+            index.scores[rows, ranks] = sums
+        return index
+
+    def state(self):
+        return {
+            'parameters': np.array([self.k, self.max_share, self.min_rows], dtype=np.float64),
+            'vocabulary': pack_strings(self.vocabulary),
+            'offsets': self.offsets,
+            'terms': self.terms,
+            'counts': self.counts,
+            'term_offsets': self.term_offsets,
+            'term_rows': self.term_rows,
+            'term_counts': self.term_counts,
+            'neighbours': self.neighbours,
+            'scores': self.scores,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls.__new__(cls)
+        k, index.max_share, min_rows = (float(value) for value in state['parameters'])
+        index.k, index.min_rows = int(k), int(min_rows)
+        index.vocabulary = unpack_strings(state['vocabulary'])
+        # Term ids are only needed to apply changes, so the lookup is built then
+        index._term_ids = None
+        index.offsets = state['offsets']
+        index.terms = state['terms']
+        index.counts = state['counts']
+        index.term_offsets = state['term_offsets']
+        index.term_rows = state['term_rows']
+        index.term_counts = state['term_counts']
+        index.neighbours = state['neighbours']
+        index.scores = state['scores']
+        return index
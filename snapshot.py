@@ -0,0 +1,163 @@
+"""
+Binary columnar snapshots of the medicine catalog
+
+A snapshot is a directory of NumPy .npy files holding the cleaned catalog
+columns and every derived index, plus a meta.json describing them. Loading
+memory-maps the arrays read-only, so nothing is parsed or rebuilt at startup
+and all workers mapping the same snapshot share its pages.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from search_index import pack_strings, unpack_strings
+
+# Bumped whenever the layout of the snapshot files changes
+FORMAT_VERSION = 9
+
+META_FILE = 'meta.json'
+
+
+def source_signature(path):
+    """Return the size and modification time identifying a source file"""
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def encode_strings(values):
+    """
+    Pack a sequence of strings, some possibly missing, as the distinct
+    strings plus one code per value.
+    """
+    codes, distinct = pd.factorize(np.asarray(values, dtype=object))
+    state = pack_strings(distinct.astype(str))
+    state['codes'] = codes.astype(np.int32)
+    return state
+
+
+def decode_strings(state):
+    """
+    Rebuild the values packed by encode_strings as an object array in which
+    equal strings are one shared object.
+    """
+    # Missing values have code -1, which selects the trailing NaN
+    distinct = np.array(unpack_strings(state) + [np.nan], dtype=object)
+    return distinct[state['codes']]
+
+
+def encode_frame(df):
+    """
+    Split a DataFrame into column descriptions and arrays. Text columns are
+    packed with encode_strings, categorical columns into their codes and
+    packed categories; other columns are stored as they are.
+    """
+    columns = []
+    state = {}
+    for name in df.columns:
+        series = df[name]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            column_state = pack_strings(series.cat.categories.astype(str))
+            column_state['codes'] = series.cat.codes.to_numpy()
+            columns.append({'name': name, 'kind': 'category'})
+        elif series.dtype == object:
+            column_state = encode_strings(series)
+            columns.append({'name': name, 'kind': 'string'})
+        else:
+            column_state = {'values': series.to_numpy()}
+            columns.append({'name': name, 'kind': 'values'})
+        state[name] = column_state
+    return columns, state
+
+
+def decode_frame(columns, state):
+    """Rebuild a DataFrame from the output of encode_frame"""
+    data = {}
+    for column in columns:
+        column_state = state[column['name']]
+        if column['kind'] == 'string':
+            values = decode_strings(column_state)
+        elif column['kind'] == 'category':
+            values = pd.Categorical.from_codes(
+                np.array(column_state['codes']), unpack_strings(column_state)
+            )
+        else:
+            # Copied out of the mapping: the DataFrame owns its values
+            values = np.array(column_state['values'])
+        data[column['name']] = values
+    return pd.DataFrame(data)
+
+
+def _flatten(state, prefix=''):
+    for key, value in state.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f'{prefix}{key}/')
+        else:
+            yield f'{prefix}{key}', value
+
+
+def write_snapshot(path, meta, state):
+    """
+    Write a snapshot directory. state is a nested dict of arrays and meta a
+    JSON-serializable dict; an existing snapshot at path is replaced only
+    once the new one is complete.
+    """
+    temporary = path + '.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+
+    arrays = []
+    for name, array in _flatten(state):
+        file_path = os.path.join(temporary, name + '.npy')
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        np.save(file_path, np.ascontiguousarray(array), allow_pickle=False)
+        arrays.append(name)
+
+    with open(os.path.join(temporary, META_FILE), 'w') as f:
+        json.dump(dict(meta, format=FORMAT_VERSION, arrays=arrays), f, indent=2)
+
+    # Processes still mapping the old files keep them until they unmap
+    previous = path + '.old'
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, previous)
+    os.rename(temporary, path)
+    shutil.rmtree(previous, ignore_errors=True)
+
+
+def read_meta(path):
+    """Return the meta dict of a snapshot, or None if there is no usable one"""
+    try:
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('format') == FORMAT_VERSION else None
+
+
+def read_snapshot(path):
+    """
+    Return (meta, state) for a snapshot directory, with every array
+    memory-mapped read-only. Raises ValueError if there is no usable snapshot.
+    """
+    meta = read_meta(path)
+    if meta is None:
+        raise ValueError(f'No catalog snapshot at {path}')
+
+    state = {}
+    for name in meta['arrays']:
+        *parents, leaf = name.split('/')
+        node = state
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[leaf] = np.load(os.path.join(path, name + '.npy'), mmap_mode='r', allow_pickle=False)
+    return meta, state
+
+
+def is_current(path, source_path):
+    """Return whether the snapshot at path was built from source_path as it is now"""
+    meta = read_meta(path)
+    if meta is None or not os.path.exists(source_path):
+        return False
+    return meta.get('source') == source_signature(source_path)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+In-process tests for the medicine catalog
+Builds catalogs from the sample CSV, no server needed
+"""
+import io
+import math
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from catalog import CatalogReloader, MedicineCatalog, SIMILAR_LIMIT, similarity_documents
+from config import Config
+from deltas import read_delta
+from search_cache import search_cache
+from search_index import count_terms
+
+SAMPLE_PATH = os.path.join(os.path.dirname(__file__), 'data', 'medicines_sample.csv')
+
+
+def test_similar_medicines_exact(catalog):
+    """Test that a small catalog gets exactly the most similar medicines"""
+    print("Testing similar medicines against a brute-force TF-IDF...")
+    counts = [count_terms(fields) for fields in similarity_documents(catalog.df)]
+    num_rows = len(counts)
+    frequency = {}
+    for row_counts in counts:
+        for term in row_counts:
+            frequency[term] = frequency.get(term, 0) + 1
+    # Every term of the sample is below the 100-row floor, so none is dropped
+    vectors = []
+    for row_counts in counts:
+        vector = {
+            term: (1 + math.log(count)) * (math.log((1 + num_rows) / (1 + frequency[term])) + 1)
+            for term, count in row_counts.items()
+        }
+        norm = math.sqrt(sum(weight ** 2 for weight in vector.values())) or 1
+        vectors.append({term: weight / norm for term, weight in vector.items()})
+
+    for row_id in range(num_rows):
+        expected = sorted(
+            (sum(weight * vectors[other].get(term, 0) for term, weight in vectors[row_id].items()), other)
+            for other in range(num_rows) if other != row_id
+        )
+        expected = [score for score, _ in reversed(expected) if score > 1e-12][:SIMILAR_LIMIT]
+        row_ids, scores = catalog.similarity_index.similar(row_id)
+        assert len(row_ids) == len(expected), f"row {row_id}: {len(row_ids)} neighbours"
+        assert np.allclose(scores.astype(float), expected, atol=2e-3), f"row {row_id}: {scores}"
+    print(f"✓ Similar medicines are exact for {num_rows} medicines")
+
+
+def sample_delta(catalog):
+    """Return a delta CSV adding, updating and discontinuing medicines of catalog"""
+    first, second, third = (catalog.df.iloc[row_id] for row_id in range(3))
+    return f"""action,name,manufacturer,composition,uses,is_discontinued
+add,Zyloprimex 100mg Tablet,Brandnew Pharma Ltd,Allopurinol (100mg),Treatment of gout,
+add,Paracetamol Zed 650 Tablet,Cipla Ltd,Paracetamol (650mg),Pain relief and fever,No
+update,"{first['name']}","{first['manufacturer']}",Azithromycin (500mg) + Quuxacillin (10mg),,
+discontinue,"{second['name']}","{second['manufacturer']}",,,
+update,"{third['name']}","{third['manufacturer']}",,Treatment of severe hypertension,No
+"""
+
+
+def test_delta_matches_fresh_build(catalog):
+    """Test that a catalog with a delta applied answers like one built from scratch"""
+    print("\nTesting incremental deltas against a fresh build...")
+    changes = read_delta(io.StringIO(sample_delta(catalog)), catalog.source_columns)
+    updated, _ = catalog.apply_delta(changes, 'sample.csv')
+    fresh = MedicineCatalog(updated.df.copy())
+
+    assert updated.ids == fresh.ids
+    assert all(updated.resolve(key) == row_id for row_id, key in enumerate(fresh.ids))
+    for query in ('tablet', 'pain', 'quuxacillin', 'gout', 'zyloprim', 'hypertension', 'mycin', 'para'):
+        for manufacturer, discontinued in (('', 'all'), ('cipla', 'active'), ('', 'discontinued')):
+            # Both catalogs share a version, so they must not share cached pages
+            search_cache.clear()
+            got = updated.search_page(query, manufacturer, discontinued, limit=30, facets=True)
+            search_cache.clear()
+            expected = fresh.search_page(query, manufacturer, discontinued, limit=30, facets=True)
+            assert list(got.row_ids) == list(expected.row_ids), (query, manufacturer, discontinued)
+            assert got.total == expected.total and got.facets == expected.facets, query
+    for word in ('quuxacilin', 'zyloprimx', 'paracetmol'):
+        assert updated.correct_query(word) == fresh.correct_query(word), word
+    for prefix in ('zy', 'bra', 'par', 'cip'):
+        assert updated.suggest(prefix) == fresh.suggest(prefix), prefix
+    for row_id in range(len(fresh)):
+        assert list(updated.alternatives(row_id)) == list(fresh.alternatives(row_id)), row_id
+        assert list(updated.substitutes(row_id)) == list(fresh.substitutes(row_id)), row_id
+        assert list(updated.substitutes(row_id, 'active')) == list(fresh.substitutes(row_id, 'active')), row_id
+    # Similar medicines are recomputed for the changed rows only
+    for row_id in (0, len(fresh) - 2, len(fresh) - 1):
+        assert np.array_equal(updated.similar(row_id)[0], fresh.similar(row_id)[0]), row_id
+    print(f"✓ Delta matches a fresh build of {len(fresh)} medicines")
+
+
+def test_reload_keeps_concurrent_deltas():
+    """Test that a delta applied while a reload is loading survives the reload"""
+    print("\nTesting deltas applied during a reload...")
+    settings = Config.CATALOG_PATH, Config.CATALOG_SNAPSHOT_PATH, Config.CATALOG_DELTA_DIR
+    with tempfile.TemporaryDirectory() as delta_directory:
+        Config.CATALOG_PATH, Config.CATALOG_SNAPSHOT_PATH, Config.CATALOG_DELTA_DIR = (
+            SAMPLE_PATH, '', delta_directory
+        )
+        try:
+            reloader = CatalogReloader(loader=lambda: load_during_delta(reloader, delta_directory))
+            reloader.get()
+            reloader.reload()
+        finally:
+            Config.CATALOG_PATH, Config.CATALOG_SNAPSHOT_PATH, Config.CATALOG_DELTA_DIR = settings
+    assert reloader.catalog.applied_deltas == ('late.csv',)
+    assert len(reloader.catalog.search('zyloprim')) == 1
+    print(f"✓ Reload kept the delta - {len(reloader.catalog)} medicines")
+
+
+def load_during_delta(reloader, delta_directory):
+    """Load the sample catalog, applying a new delta to the live one meanwhile"""
+    catalog = MedicineCatalog.from_csv(SAMPLE_PATH)
+    if reloader.catalog is not None:
+        with open(os.path.join(delta_directory, 'late.csv'), 'w', encoding='utf-8') as f:
+            f.write(sample_delta(catalog))
+        reloader.apply_deltas()
+    return catalog
+
+
+def main():
+    """Run all tests"""
+    print("=" * 60)
+    print("Medicine Search System - Catalog Tests")
+    print("=" * 60)
+
+    try:
+        catalog = MedicineCatalog.from_csv(SAMPLE_PATH)
+        test_similar_medicines_exact(catalog)
+        test_delta_matches_fresh_build(catalog)
+        test_reload_keeps_concurrent_deltas()
+
+        print("\n" + "=" * 60)
+        print("✓ All tests passed successfully!")
+        print("=" * 60)
+        return 0
+
+    except AssertionError as e:
+        print(f"\n✗ Test failed: {e}")
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
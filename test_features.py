@@ -3,12 +3,15 @@
 Test script for Medicine Search System
 Tests basic functionality of all major features
 """
+import csv
+import os
 import requests
 import json
 import sys
 
 BASE_URL = "http://localhost:5000"
 API_URL = f"{BASE_URL}/api/v1"
+SAMPLE_PATH = os.path.join(os.path.dirname(__file__), "data", "medicines_sample.csv")
 
 def test_home_page():
     """Test if home page loads"""
@@ -26,8 +29,60 @@ def test_search_api():
     data = response.json()
     assert "medicines" in data
     assert len(data["medicines"]) > 0
+    # Queries match anywhere inside name, composition or uses, like a full scan
+    with open(SAMPLE_PATH, newline='', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    for query in ("5mg", "heart"):
+        expected = sum(
+            any(query in (row[column] or "").lower() for column in ("name", "composition", "uses"))
+            for row in rows
+        )
+        found = requests.get(f"{API_URL}/medicines/search", params={"q": query}).json()
+        assert found["total"] == expected, f"{query}: {found['total']} != {expected}"
     print(f"✓ Search API works - Found {data['count']} medicine(s)")
 
+def test_batch_search_api():
+    """Test batch medicine search API"""
+    print("\nTesting batch search API...")
+    response = requests.post(
+        f"{API_URL}/medicines/search/batch",
+        json={"queries": [{"q": "paracetamol"}, {"q": "azithromycin", "limit": 5}]}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["count"] == 2
+    assert len(data["results"][0]["medicines"]) > 0
+    response = requests.post(
+        f"{API_URL}/medicines/search/batch",
+        json={"queries": [{"q": "para", "manufacturer": None}]}
+    )
+    assert response.status_code == 200
+    assert response.json()["results"][0]["total"] > 0
+    response = requests.post(
+        f"{API_URL}/medicines/search/batch",
+        json={"queries": [{"q": "para", "discontinued": ["x"]}]}
+    )
+    assert response.status_code == 400
+    response = requests.post(
+        f"{API_URL}/medicines/search/batch",
+        json={"queries": [{"q": "paracetmol", "fuzzy": "false"}, {"q": "paracetmol", "fuzzy": True}]}
+    )
+    assert response.status_code == 200
+    off, on = response.json()["results"]
+    assert off["total"] == 0 and "corrected_query" not in off
+    assert on["corrected_query"] == "paracetamol"
+    print(f"✓ Batch search API works - {data['count']} result set(s)")
+
+def test_suggest_api():
+    """Test medicine autocomplete API"""
+    print("\nTesting suggest API...")
+    response = requests.get(f"{API_URL}/medicines/suggest?prefix=para")
+    assert response.status_code == 200
+    data = response.json()
+    assert "suggestions" in data
+    assert len(data["suggestions"]["names"]) > 0
+    print(f"✓ Suggest API works - {len(data['suggestions']['names'])} name suggestion(s)")
+
 def test_registration():
     """Test user registration"""
     print("\nTesting user registration...")
@@ -110,6 +165,22 @@ def test_interaction_checker():
     assert "interactions" in data
     print(f"✓ Interaction checker works - Found {len(data['interactions'])} interaction(s)")
 
+def test_pairwise_interactions():
+    """Test that a known ingredient pair is reported"""
+    print("\nTesting pairwise interactions...")
+    ids = [
+        requests.get(f"{API_URL}/medicines/search?q={name}&fields=name").json()["medicines"][0]["id"]
+        for name in ("warfarin", "aspirin")
+    ]
+    response = requests.post(f"{API_URL}/interactions/check", json={"medicine_indices": ids})
+    assert response.status_code == 200
+    findings = [item for item in response.json()["interactions"] if item["type"] == "known_interaction"]
+    assert findings and findings[0]["interacting_ingredients"] == ["warfarin", "aspirin"]
+    response = requests.post(f"{API_URL}/interactions/check", json={"medicine_indices": ids[::-1]})
+    findings = [item for item in response.json()["interactions"] if item["type"] == "known_interaction"]
+    assert findings and findings[0]["interacting_ingredients"] == ["aspirin", "warfarin"]
+    print(f"✓ Pairwise interactions work - {findings[0]['severity']} severity reported")
+
 def test_statistics():
     """Test statistics API"""
     print("\nTesting statistics API...")
@@ -129,6 +200,53 @@ def test_medicine_detail():
     assert "medicine" in data
     print(f"✓ Medicine detail API works - Retrieved: {data['medicine']['name']}")
 
+def test_id_only_fields():
+    """Test that fields=id and fields=index still return every medicine"""
+    print("\nTesting id-only field selection...")
+    full = requests.get(f"{API_URL}/medicines/search?q=paracetamol").json()
+    data = requests.get(f"{API_URL}/medicines/search?q=paracetamol&fields=id").json()
+    assert data["total"] == full["total"] > 0
+    assert all(set(item) == {"id", "index"} for item in data["medicines"])
+    data = requests.get(f"{API_URL}/medicines?ids=0,1&fields=id").json()
+    assert [item["index"] for item in data["medicines"]] == [0, 1]
+    data = requests.get(f"{API_URL}/medicines/0?fields=index").json()
+    assert data["medicine"]["index"] == 0
+    for path in ("similar", "substitutes"):
+        response = requests.get(f"{API_URL}/medicines/0/{path}?fields=id")
+        assert response.status_code == 200
+    print(f"✓ Id-only field selection works - {data['medicine']['id']}")
+
+def test_medicine_etag():
+    """Test conditional requests for medicine details"""
+    print("\nTesting medicine detail ETags...")
+    response = requests.get(f"{API_URL}/medicines/0")
+    medicine_id = response.json()["medicine"]["id"]
+    etag = response.headers.get("ETag")
+    assert etag
+    response = requests.get(f"{API_URL}/medicines/{medicine_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    print(f"✓ Medicine detail ETags work - {medicine_id} not modified")
+
+def test_medicine_substitutes():
+    """Test the generic equivalents endpoint"""
+    print("\nTesting medicine substitutes...")
+    response = requests.get(f"{API_URL}/medicines/0/substitutes?fields=name")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["medicine"]["index"] == 0
+    assert all(item["index"] != 0 for item in data["substitutes"])
+    print(f"✓ Substitutes work - {data['total']} medicines share {len(data['components'])} component(s)")
+
+def test_similar_medicines():
+    """Test the similar medicines endpoint"""
+    print("\nTesting similar medicines...")
+    response = requests.get(f"{API_URL}/medicines/0/similar?limit=3&fields=name")
+    assert response.status_code == 200
+    data = response.json()
+    scores = [item["score"] for item in data["similar"]]
+    assert len(scores) <= 3 and scores == sorted(scores, reverse=True)
+    print(f"✓ Similar medicines work - {data['count']} found")
+
 def main():
     """Run all tests"""
     print("=" * 60)
@@ -138,12 +256,19 @@ def main():
     try:
         test_home_page()
         test_search_api()
+        test_batch_search_api()
+        test_suggest_api()
         token = test_registration()
         token2 = test_login()
         test_saved_search(token2)
         test_interaction_checker()
+        test_pairwise_interactions()
         test_statistics()
         test_medicine_detail()
+        test_id_only_fields()
+        test_medicine_etag()
+        test_medicine_substitutes()
+        test_similar_medicines()
         
         print("\n" + "=" * 60)
         print("✓ All tests passed successfully!")